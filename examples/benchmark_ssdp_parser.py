@@ -0,0 +1,36 @@
+"""Benchmark the ssdp response parser on a recorded capture."""
+import email
+import os.path
+import re
+import sys
+import timeit
+from io import StringIO
+
+from sonyapilib.ssdp import _parse_response
+
+CAPTURE = os.path.join(os.path.dirname(__file__), "..", "tests", "data", "ssdp.txt")
+
+
+def load_datagrams(file_name):
+    """Split a capture into the datagrams it consists of."""
+    with open(file_name) as capture:
+        data = capture.read()
+    return [part.replace("\n", "\r\n").encode()
+            for part in re.split(r"(?m)^(?=HTTP/1\.1 200 OK)", data) if part.strip()]
+
+
+def parse_email(datagram):
+    """Parse a datagram the way it was done with the email module."""
+    _, _, headers = datagram.decode().partition("\r\n")
+    return dict(email.message_from_file(StringIO(headers)).items())
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    datagrams = load_datagrams(CAPTURE) * repeat
+    print(f"Parsing {len(datagrams)} datagrams")
+    for name, parser in (("email", parse_email), ("bytes", _parse_response)):
+        duration = timeit.timeit(
+            lambda parser=parser: [parser(datagram) for datagram in datagrams], number=3) / 3
+        print(f"{name}: {duration * 1000:.1f} ms, "
+              f"{duration / len(datagrams) * 1e6:.2f} us per datagram")
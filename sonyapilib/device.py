@@ -1,10 +1,19 @@
 """Sony Media player lib"""
 import base64
+import functools
+import hashlib
 import json
 import logging
+import random
 import struct
+import threading
+import time
 import xml.etree.ElementTree
+from collections import Counter, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 from enum import Enum
+from types import MappingProxyType
 from urllib.parse import (
     urljoin,
     urlparse,
@@ -16,16 +25,63 @@ import requests
 import wakeonlan
 
 from sonyapilib import ssdp
+from sonyapilib.icons import DEFAULT_CACHE as DEFAULT_ICON_CACHE
+from sonyapilib.limiter import Priority
+from sonyapilib.webapi import DEFAULT_PAGE_SIZE, WebApiClient, WebApiError
 from sonyapilib.xml_helper import find_in_xml
 
 _LOGGER = logging.getLogger(__name__)
 
+# default connect and read timeout of requests without a timeout policy
 TIMEOUT = 5
+# seconds until the app list is read again from the device
+APP_LIST_TTL = 3600
+# seconds before expiry the auth cookie of v4 devices is renewed
+AUTH_REFRESH_MARGIN = 300
+# seconds between attempts to renew the auth cookie after a failure
+AUTH_RETRY_INTERVAL = 60
+DEFAULT_NICKNAME = "sonyapilib"
+# attributes of SonyDevice which are not stored in json
+RUNTIME_ATTRIBUTES = ("_session", "_refreshing", "_apps_updated", "_apps_lock",
+                      "_foreground_app", "_root_cookies", "_auth_lock",
+                      "_auth_retry_at", "_auth_timer", "_metrics", "_header_view",
+                      "_timeouts", "_local", "_retries", "_limiter", "_channel",
+                      "_channel_stats", "_webapi", "_hedge_executor")
+# attributes compared by SonyDevice.refresh
+DIFF_ATTRIBUTES = (
+    "mac", "api_version", "base_url", "control_url", "actionlist_url",
+    "av_transport_url", "rendering_control_url", "app_url",
+    "friendly_name", "model_name", "model_number", "icons",
+)
 URN_UPNP_DEVICE = "{urn:schemas-upnp-org:device-1-0}"
 URN_SONY_AV = "{urn:schemas-sony-com:av}"
 URN_SONY_IRCC = "urn:schemas-sony-com:serviceId:IRCC"
+URN_DIAL = "{urn:dial-multiscreen-org:schemas:dial}"
 URN_SCALAR_WEB_API_DEVICE_INFO = "{urn:schemas-sony-com:av}"
 WEBAPI_SERVICETYPE = "av:X_ScalarWebAPI_ServiceType"
+SSDP_ST_IRCC = "urn:schemas-sony-com:service:IRCC:1"
+SSDP_ST_SCALAR_WEB_API = "urn:schemas-sony-com:service:ScalarWebAPI:1"
+# header sets shared by all requests, they must not be modified
+JSON_HEADERS = MappingProxyType({"Content-Type": "application/json"})
+NO_HEADERS = MappingProxyType({})
+
+
+@functools.lru_cache(maxsize=None)
+def _soap_headers(action):
+    """Get the headers of a SOAP request for the given action."""
+    return MappingProxyType({
+        'SOAPACTION': f'"{action}"',
+        "Content-Type": "text/xml"
+    })
+
+
+@functools.lru_cache(maxsize=16)
+def _basic_auth(pin):
+    """Get the value of the Authorization header for the given pin."""
+    username = ''
+    base64string = base64.encodebytes(f'{username}:{pin}'.encode())\
+        .decode().replace('\n', '')
+    return f"Basic {base64string}"
 
 
 class AuthenticationResult(Enum):
@@ -107,6 +163,95 @@ IR_KEY_CODES = {
 }
 
 
+class TimeoutPolicy(namedtuple("TimeoutPolicy", ["connect", "read", "deadline"],
+                               defaults=(None,))):
+    """Timeouts in seconds used for the requests of an operation.
+
+    The deadline limits the total time of an operation, e.g. all requests
+    reading the description of a device. None means no limit.
+    """
+
+    __slots__ = ()
+
+
+DEFAULT_TIMEOUTS = {
+    # checking if the device is reachable
+    "probe": TimeoutPolicy(1, 2, 3),
+    # checking if the device is reachable while powering it on
+    "power": TimeoutPolicy(1, 2, 3),
+    "keypress": TimeoutPolicy(2, 5),
+    "status": TimeoutPolicy(2, 5),
+    # description documents, command and app lists
+    "description": TimeoutPolicy(3, 15, 60),
+    # the user might need to confirm the registration on the device
+    "registration": TimeoutPolicy(5, 30),
+}
+
+
+class RetryPolicy(namedtuple("RetryPolicy", ["retries", "backoff", "max_backoff", "hedge_after"],
+                             defaults=(0, 0.2, 2, None))):
+    """Retries of the requests of an operation.
+
+    Requests failing with a connection error, a timeout or a server error
+    are retried up to retries times after a jittered exponential backoff
+    in seconds. If hedge_after is set, a second identical GET request is
+    sent if the first one did not respond within that many seconds and
+    the first response is used.
+    """
+
+    __slots__ = ()
+
+
+# only idempotent operations are retried by default, other operations like
+# keypresses are only retried if a policy is configured for the device
+DEFAULT_RETRIES = {
+    "description": RetryPolicy(1),
+    "status": RetryPolicy(1),
+}
+
+# priority of the requests of an operation if a RateLimiter is used
+OPERATION_PRIORITIES = {
+    "keypress": Priority.KEYPRESS,
+    "registration": Priority.KEYPRESS,
+    "power": Priority.POWER,
+    "probe": Priority.POLLING,
+    "status": Priority.POLLING,
+    "description": Priority.BACKGROUND,
+}
+
+# operations like changing the volume can be sent over both channels of v4 devices
+CHANNEL_IRCC = "ircc"
+CHANNEL_WEBAPI = "webapi"
+# weight of the latest request in the channel statistics
+CHANNEL_SMOOTHING = 0.2
+# every nth operation the channel ranked second is tried first by idempotent
+# operations, to keep its statistics up to date
+CHANNEL_EXPLORE_EVERY = 20
+
+# sends hedged reads of devices without their own executor
+_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sonyapilib-hedge")
+
+
+class _DeadlineExceeded(requests.exceptions.Timeout):
+    """The deadline of an operation passed before a request was sent."""
+
+
+def _is_transient(ex):
+    """Check if a failed request might succeed when sent again."""
+    if isinstance(ex, _DeadlineExceeded):
+        return False
+    if isinstance(ex, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    status_code = getattr(ex.response, "status_code", None)
+    return status_code is not None and status_code >= 500
+
+
+class ChannelStats(namedtuple("ChannelStats", ["latency", "success_rate", "requests"])):
+    """Smoothed latency in seconds and success rate of a channel."""
+
+    __slots__ = ()
+
+
 class XmlApiObject:
     # pylint: disable=too-few-public-methods
     """Holds data for a device action or a command."""
@@ -131,6 +276,22 @@ class XmlApiObject:
             setattr(self, attr, xml_data.get(attr))
 
 
+class DeviceDiff(namedtuple("DeviceDiff", [
+        "apps_added", "apps_removed", "commands_added", "commands_removed",
+        "changed"])):
+    """Changes found by refreshing a device.
+
+    Apps and commands are sets of names, changed maps the attribute name
+    to a tuple of the old and the new value.
+    """
+
+    __slots__ = ()
+
+    def __bool__(self):
+        """Check if anything changed."""
+        return any(self)
+
+
 class SonyDevice:
     # pylint: disable=too-many-public-methods
     # pylint: disable=too-many-instance-attributes
@@ -180,6 +341,8 @@ class SonyDevice:
         self.cookies = None
         self.mac = None
         self.api_version = 0
+        # content hashes of the resources read from the device
+        self.resource_hashes = {}
 
         self.dmr_base = f"http://{self.host}:{self.dmr_port}"
         self.dmr_url = f"{self.dmr_base}/dmr.xml"
@@ -194,37 +357,341 @@ class SonyDevice:
         self.irccscpd_url = urljoin(self.ircc_base, "/IRCCSCPD.xml")
         self._ircc_categories = set()
         self._add_headers()
+        self._init_runtime_attributes()
+
+    def _init_runtime_attributes(self):
+        """Set the attributes which are not stored, see __getstate__."""
+        self._session = None
+        self._refreshing = False
+        self._apps_updated = None
+        self._apps_lock = threading.Lock()
+        # the app started last by this object
+        self._foreground_app = None
+        self._root_cookies = None
+        self._auth_lock = threading.Lock()
+        self._auth_retry_at = 0
+        self._auth_timer = None
+        self._metrics = Counter()
+        self._header_view = None
+        self._timeouts = {}
+        self._local = threading.local()
+        self._retries = {}
+        self._limiter = None
+        self._channel = None
+        self._channel_stats = {}
+        self._webapi = None
+        self._hedge_executor = None
+
+    def __getstate__(self):
+        """Exclude runtime only attributes from the stored configuration."""
+        return {key: value for key, value in self.__dict__.items()
+                if key not in RUNTIME_ATTRIBUTES}
+
+    def __setstate__(self, state):
+        """Restore a stored configuration and init the runtime attributes."""
+        self.__dict__.update(state)
+        self._init_runtime_attributes()
+
+    @property
+    def session(self):
+        """Get the requests session used for http requests."""
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        """Share a requests session, e.g. to use a common connection pool."""
+        self._session = session
+
+    @property
+    def metrics(self):
+        """Get counters of sent requests, auth refreshes and failures."""
+        return self._metrics
+
+    @property
+    def timeouts(self):
+        """Get the timeout policies overriding DEFAULT_TIMEOUTS for this device."""
+        return self._timeouts
+
+    def get_timeout(self, operation):
+        """Get the TimeoutPolicy used for the requests of an operation."""
+        policy = self.timeouts.get(operation) or DEFAULT_TIMEOUTS.get(operation)
+        return policy or TimeoutPolicy(TIMEOUT, TIMEOUT)
+
+    @property
+    def limiter(self):
+        """Get the RateLimiter used for requests, None if not limited."""
+        return self._limiter
+
+    @limiter.setter
+    def limiter(self, limiter):
+        """Limit the rate of requests, e.g. for firmware which is slow."""
+        self._limiter = limiter
+
+    @property
+    def hedge_executor(self):
+        """Get the executor sending hedged reads, shared by all devices by default."""
+        return self._hedge_executor or _HEDGE_EXECUTOR
+
+    @hedge_executor.setter
+    def hedge_executor(self, executor):
+        """Use an executor sized for the requests which may run at once."""
+        self._hedge_executor = executor
+
+    @property
+    def webapi(self):
+        """Get the ScalarWebAPI client of v4 devices."""
+        if self._webapi is None:
+            self._webapi = WebApiClient(self)
+        return self._webapi
+
+    @property
+    def channel(self):
+        """Get the channel all operations are sent over, None to select by latency."""
+        return self._channel
+
+    @channel.setter
+    def channel(self, channel):
+        """Force operations to use CHANNEL_IRCC or CHANNEL_WEBAPI."""
+        self._channel = channel
+
+    @property
+    def channel_stats(self):
+        """Get the ChannelStats of all channels used so far."""
+        return self._channel_stats
+
+    @property
+    def retries(self):
+        """Get the retry policies overriding DEFAULT_RETRIES for this device."""
+        return self._retries
+
+    def get_retry_policy(self, operation):
+        """Get the RetryPolicy used for the requests of an operation."""
+        policy = self.retries.get(operation) or DEFAULT_RETRIES.get(operation)
+        return policy or RetryPolicy()
+
+    def _operation_deadline(self, operation):
+        """Limit the total time of all requests within to the deadline of operation.
+
+        Requests started later fail with a Timeout.
+        """
+        deadline = self.get_timeout(operation).deadline
+        return self._deadline(None if deadline is None else time.monotonic() + deadline)
+
+    @contextmanager
+    def _deadline(self, end):
+        """Let requests within fail with a Timeout after the monotonic time end."""
+        local = self._local
+        if end is None or getattr(local, "deadline", None) is not None:
+            # no limit or within an operation which already has one
+            yield
+            return
+        local.deadline = end
+        try:
+            yield
+        finally:
+            local.deadline = None
+
+    def _request_timeout(self, operation):
+        """Get the connect and read timeout for a request of an operation."""
+        policy = self.get_timeout(operation)
+        limit = policy.deadline
+        deadline = getattr(self.__dict__.get("_local"), "deadline", None)
+        if deadline is not None:
+            limit = deadline - time.monotonic()
+            if limit <= 0:
+                raise _DeadlineExceeded(f"deadline of {operation} exceeded")
+        if limit is None:
+            return policy.connect, policy.read
+        return min(policy.connect, limit), min(policy.read, limit)
+
+    @property
+    def auth_expires(self):
+        """Get the expiry of the auth cookie as unix time, None if unknown."""
+        for cookie in self.cookies or ():
+            if cookie.name == "auth":
+                return cookie.expires
+        return None
 
     def init_device(self):
         """Update this object with data from the device"""
         self._set_value('broadcast_address', '255.255.255.255')
+        # the app list is loaded on first use
+        with self._operation_deadline("description"):
+            self._update(apps=False)
+
+    def refresh(self):
+        """Update this object, only parsing resources which have changed.
+
+        In contrast to init_device existing values are replaced and
+        removed apps or commands are dropped.
+        Returns a DeviceDiff describing the changes.
+        """
+        before = self._snapshot()
+        self._refreshing = True
+        try:
+            with self._operation_deadline("description"):
+                self._update()
+        finally:
+            self._refreshing = False
+        return self._diff(before)
 
+    def _update(self, apps=True):
         self._update_service_urls()
         self._update_commands()
         self._add_headers()
 
         if self.pin:
             self._recreate_authentication()
-            self._update_applist()
+            if apps:
+                self._update_applist()
+
+    def _snapshot(self):
+        values = {name: getattr(self, name, None) for name in DIFF_ATTRIBUTES}
+        return values, set(self.apps), set(self.commands)
+
+    def _diff(self, before):
+        values, apps, commands = before
+        changed = {name: (value, getattr(self, name, None))
+                   for name, value in values.items()
+                   if value != getattr(self, name, None)}
+        return DeviceDiff(
+            apps_added=set(self.apps) - apps,
+            apps_removed=apps - set(self.apps),
+            commands_added=set(self.commands) - commands,
+            commands_removed=commands - set(self.commands),
+            changed=changed,
+        )
+
+    def _fetch_resource(self, name, url, method=HttpMethod.GET, **kwargs):
+        """Request a resource and remember the hash of its content.
+
+        While refreshing None is returned if the content did not change,
+        so parsing it can be skipped.
+        """
+        response = self._send_http(url, method, operation="description", **kwargs)
+        content = getattr(response, "content", None)
+        if not content:
+            return response
+
+        digest = hashlib.sha1(content).hexdigest()
+        # devices restored from older json do not have stored hashes
+        hashes = getattr(self, "resource_hashes", None)
+        if hashes is None:
+            hashes = self.resource_hashes = {}
+        unchanged = hashes.get(name) == digest
+        hashes[name] = digest
+        if unchanged and self._refreshing:
+            _LOGGER.debug("%s did not change", name)
+            return None
+        return response
+
+    def _store_table(self, attribute, table):
+        """Replace a table while refreshing, otherwise add the entries."""
+        if self._refreshing:
+            setattr(self, attribute, table)
+        else:
+            getattr(self, attribute).update(table)
 
     @staticmethod
-    def discover():
-        """Discover all available devices."""
-        discovery = ssdp.SSDPDiscovery()
+    def discover(nickname=DEFAULT_NICKNAME, init=False, max_workers=8,
+                 timeout=TIMEOUT * 3, discovery=None):
+        # pylint: disable=too-many-arguments
+        """Discover all available devices.
+
+        The nickname is the name the devices will show for this client.
+        If init is set the devices are initialized concurrently, see
+        init_devices, and its result is returned instead of the list.
+        A ssdp.SSDPDiscoveryCache can be passed as discovery to reuse
+        previous results.
+        """
+        discovery = discovery or ssdp.SSDPDiscovery()
         devices = []
-        for device in discovery.discover(
-                "urn:schemas-sony-com:service:IRCC:1"
-        ):
-            host = device.location.split(":")[1].split("//")[1]
-            devices.append(SonyDevice(host, device.location))
+        for device in discovery.discover(SSDP_ST_IRCC):
+            devices.append(SonyDevice._from_ssdp_response(device, nickname))
 
+        if init:
+            return SonyDevice.init_devices(devices, max_workers, timeout)
         return devices
 
     @staticmethod
-    def load_from_json(data):
-        """Load a device configuration from a stored json."""
+    async def discover_async(timeout=1, services=(SSDP_ST_IRCC, SSDP_ST_SCALAR_WEB_API),
+                             nickname=DEFAULT_NICKNAME):
+        """Discover available devices and yield each one as soon as it answers.
+
+        Devices answering for more than one service type are yielded once.
+        """
+        discovery = ssdp.AsyncSSDPDiscovery()
+        hosts = set()
+        async for response in discovery.discover(services, timeout=timeout):
+            device = SonyDevice._from_ssdp_response(response, nickname)
+            if device.host in hosts:
+                continue
+            hosts.add(device.host)
+            yield device
+
+    @staticmethod
+    def _from_ssdp_response(response, nickname=DEFAULT_NICKNAME):
+        return SonyDevice(urlparse(response.location).hostname, nickname)
+
+    @staticmethod
+    def init_devices(devices, max_workers=8, timeout=TIMEOUT * 3):
+        # pylint: disable=too-many-locals
+        """Initialize many devices concurrently.
+
+        At most max_workers devices are initialized at the same time.
+        A device which is not done timeout seconds after its initialization
+        started counts as failed, its worker finishes in the background.
+        Returns the list of initialized devices and a dict containing the
+        exception for every failed device.
+        """
+        started = {}
+
+        def init(device):
+            started[device] = time.monotonic()
+            device.init_device()
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {executor.submit(init, device): device for device in devices}
+        pending = set(futures)
+        failures = {}
+        while pending:
+            now = time.monotonic()
+            deadlines = {future: started[futures[future]] + timeout
+                         for future in pending if futures[future] in started}
+            for future in [future for future, deadline in deadlines.items()
+                           if deadline <= now]:
+                del deadlines[future]
+                pending.discard(future)
+                failures[futures[future]] = TimeoutError(
+                    f"Initialization did not finish within {timeout}s")
+            if not pending:
+                break
+
+            wait_time = min(deadlines.values(), default=now + timeout) - now
+            done, pending = wait(pending, max(wait_time, 0), FIRST_COMPLETED)
+            for future in done:
+                if future.exception():
+                    failures[futures[future]] = future.exception()
+        executor.shutdown(wait=False)
+
+        for device, ex in failures.items():
+            _LOGGER.error("Failed to initialize %s: %s", device.host, ex)
+        return [device for device in devices if device not in failures], failures
+
+    @staticmethod
+    def load_from_json(data, init=True):
+        """Load a device configuration from a stored json.
+
+        If init is not set the device is not updated from the network,
+        the stored data is used until init_device is called.
+        """
         device = jsonpickle.decode(data)
-        device.init_device()
+        if isinstance(device, SonyDevice) and any(
+                name not in device.__dict__ for name in RUNTIME_ATTRIBUTES):
+            # older configurations are restored without calling __setstate__
+            device.__setstate__(device.__getstate__())
+        if init:
+            device.init_device()
         return device
 
     def save_to_json(self):
@@ -236,7 +703,7 @@ class SonyDevice:
     def _update_service_urls(self):
         """Initialize the device by reading the necessary resources from it."""
         try:
-            response = self._send_http(self.dmr_url, method=HttpMethod.GET, raise_errors=True)
+            response = self._fetch_resource("dmr", self.dmr_url, raise_errors=True)
         except requests.exceptions.ConnectionError:
             response = None
         except requests.exceptions.RequestException as exc:
@@ -258,7 +725,7 @@ class SonyDevice:
             _LOGGER.error("failed to get device information: %s", str(ex))
 
     def _parse_action_list(self):
-        response = self._send_http(self.actionlist_url, method=HttpMethod.GET)
+        response = self._fetch_resource("actionlist", self.actionlist_url)
         if not response:
             return
 
@@ -284,8 +751,9 @@ class SonyDevice:
                     action.url = action.url + "&wolSupport=true"
 
     def _parse_ircc(self):
-        response = self._send_http(
-            self.ircc_url, method=HttpMethod.GET, raise_errors=True)
+        response = self._fetch_resource("ircc", self.ircc_url, raise_errors=True)
+        if response is None:
+            return
 
         upnp_device = f"{URN_UPNP_DEVICE}device"
 
@@ -374,7 +842,7 @@ class SonyDevice:
             upnp_device=upnp_device
         ))
 
-        if hasattr(self, 'icons') and self.icons:
+        if getattr(self, 'icons', None) and not self._refreshing:
             return
 
         icons = find_in_xml(
@@ -399,23 +867,22 @@ class SonyDevice:
         return element.text if element is not None else None
 
     def _parse_system_information_v4(self):
-        url = urljoin(self.base_url, "system")
-        json_data = self._create_api_json("getSystemSupportedFunction")
-        response = self._send_http(url, HttpMethod.POST, json=json_data)
-        if not response:
-            _LOGGER.debug("no response received, device might be off")
+        try:
+            result = self.webapi.call("system", "getSystemSupportedFunction",
+                                      operation="description")
+        except (WebApiError, requests.exceptions.RequestException) as ex:
+            _LOGGER.debug("no response received, device might be off: %s", ex)
             return
 
-        json_resp = response.json()
-        if json_resp and not json_resp.get('error'):
-            for option in json_resp.get('result')[0]:
-                if option['option'] == 'WOL':
-                    self.mac = option['value']
+        for option in result[0]:
+            if option['option'] == 'WOL':
+                self.mac = option['value']
 
     def _parse_system_information(self):
         response = self._send_http(
             self._get_action(
-                "getSystemInformation").url, method=HttpMethod.GET)
+                "getSystemInformation").url, method=HttpMethod.GET,
+            operation="description")
         if not response:
             return
 
@@ -499,10 +966,11 @@ class SonyDevice:
     def _parse_command_list_v4(self):
         action_name = "getRemoteCommandList"
         action = self.actions[action_name]
-        json_data = self._create_api_json(action.value)
+        # the response echoes the id, a fixed one keeps its hash unchanged
+        json_data = dict(self._create_api_json(action.value), id=1)
 
-        response = self._send_http(
-            action.url, HttpMethod.POST, json=json_data, headers={}
+        response = self._fetch_resource(
+            "commands", action.url, HttpMethod.POST, json=json_data, headers=NO_HEADERS
         )
 
         if not response:
@@ -511,11 +979,13 @@ class SonyDevice:
 
         json_resp = response.json()
         if json_resp and not json_resp.get('error'):
+            commands = {}
             for command in json_resp.get('result')[1]:
                 api_object = XmlApiObject(command)
                 if api_object.name == "PowerOff":
                     api_object.name = "Power"
-                self.commands[api_object.name] = api_object
+                commands[api_object.name] = api_object
+            self._store_table("commands", commands)
         else:
             _LOGGER.error("JSON request error: %s",
                           json.dumps(json_resp, indent=4))
@@ -529,16 +999,17 @@ class SonyDevice:
             return
 
         action = self.actions[action_name]
-        url = action.url
-        response = self._send_http(url, method=HttpMethod.GET)
+        response = self._fetch_resource("commands", action.url)
         if not response:
             _LOGGER.debug(
-                "Failed to get response for command list, device might be off")
+                "No new command list received, device might be off")
             return
 
+        commands = {}
         for command in find_in_xml(response.text, [("command", True)]):
             name = command.get("name")
-            self.commands[name] = XmlApiObject(command.attrib)
+            commands[name] = XmlApiObject(command.attrib)
+        self._store_table("commands", commands)
 
     def _use_builtin_command_list(self):
         for encoded_str in self._ircc_categories:
@@ -567,21 +1038,42 @@ class SonyDevice:
         """Update the list of apps which are supported by the device."""
         if self.api_version < 4:
             url = self.app_url + "/appslist"
-            response = self._send_http(url, method=HttpMethod.GET)
+            response = self._fetch_resource("apps", url)
         else:
             url = f'http://{self.host}/DIAL/sony/applist'
-            response = self._send_http(
-                url,
-                method=HttpMethod.GET,
-                cookies=self._recreate_auth_cookie())
+            response = self._fetch_resource(
+                "apps", url, cookies=self._recreate_auth_cookie())
 
         if response:
+            apps = {}
             for app in find_in_xml(response.text, [(".//app", True)]):
+                icon_url = app.findtext("icon_url", "").strip()
                 data = XmlApiObject({
                     "name": app.find("name").text,
                     "id": app.find("id").text,
+                    "url": icon_url or None,
                 })
-                self.apps[data.name] = data
+                apps[data.name] = data
+            self._store_table("apps", apps)
+            # a failed request is repeated by the next caller
+            self._apps_updated = time.monotonic()
+
+    def _load_applist(self, newer_than=None):
+        """Read the app list unless it was updated after newer_than.
+
+        By default the list is read if it is older than APP_LIST_TTL.
+        Concurrent callers wait for a single request instead of
+        sending their own.
+        """
+        if not self.pin:
+            return
+        if newer_than is None:
+            newer_than = time.monotonic() - APP_LIST_TTL
+        with self._apps_lock:
+            updated = self._apps_updated
+            if updated is not None and updated > newer_than:
+                return
+            self._update_applist()
 
     def _recreate_authentication(self):
         """Recreate auth authentication"""
@@ -590,16 +1082,13 @@ class SonyDevice:
             return
 
         self._add_headers()
-        username = ''
-        base64string = base64.encodebytes(f'{username}:{self.pin}'.encode())\
-            .decode().replace('\n', '')
-
-        self.headers['Authorization'] = f"Basic {base64string}"
+        headers = {'Authorization': _basic_auth(self.pin)}
         if registration_action.mode == 4:
-            self.headers['Connection'] = "keep-alive"
+            headers['Connection'] = "keep-alive"
 
         if self.psk:
-            self.headers['X-Auth-PSK'] = self.psk
+            headers['X-Auth-PSK'] = self.psk
+        self._update_headers(headers)
 
     def _create_api_json(self, method, params=None):
         # pylint: disable=invalid-name
@@ -615,12 +1104,12 @@ class SonyDevice:
                 "function": "WOL"
             }]]
 
-        return {
-            "method": method,
-            "params": params,
-            "id": 1,
-            "version": "1.0"
-        }
+        return self.webapi.request(method, params)
+
+    def _post_webapi(self, service, data, **kwargs):
+        """Post a json-rpc request to a ScalarWebAPI service."""
+        return self._send_http(urljoin(self.base_url, service), HttpMethod.POST,
+                               json=data, **kwargs)
 
     # pylint: disable=R1710
     def _send_http(self, url, method, **kwargs):
@@ -629,33 +1118,79 @@ class SonyDevice:
         log_errors = kwargs.pop("log_errors", True)
         raise_errors = kwargs.pop("raise_errors", False)
         method = kwargs.pop("method", method.value)
+        operation = kwargs.pop("operation", None)
 
-        params = {
-            "cookies": self.cookies,
-            "timeout": TIMEOUT,
-            "headers": self.headers,
-        }
-        params.update(kwargs)
+        kwargs.setdefault("cookies", self.cookies)
+        kwargs.setdefault("headers", self._request_headers())
 
         _LOGGER.debug(
             "Calling http url %s method %s", url, method)
 
-        try:
-            response = getattr(requests, method)(url, **params)
+        policy = self.get_retry_policy(operation)
+        explicit_timeout = "timeout" in kwargs
+        attempt = 0
+        while True:
+            try:
+                self._wait_for_limiter(operation)
+                if not explicit_timeout:
+                    kwargs["timeout"] = self._request_timeout(operation)
+                return self._request(url, method, policy.hedge_after, kwargs)
+            except requests.exceptions.RequestException as ex:
+                if attempt < policy.retries and _is_transient(ex):
+                    attempt += 1
+                    self.metrics["retries", urlparse(url).path] += 1
+                    backoff = min(policy.backoff * 2 ** (attempt - 1), policy.max_backoff)
+                    _LOGGER.debug("Retrying %s after %s", url, ex)
+                    time.sleep(random.uniform(0, backoff))
+                    continue
+                if getattr(ex.response, "status_code", None) in (401, 403):
+                    self.metrics["auth_failures"] += 1
+                if log_errors:
+                    _LOGGER.error("HTTPError: %s", str(ex))
+                if raise_errors:
+                    raise
+                return None
+
+    def _wait_for_limiter(self, operation):
+        """Wait until the limiter allows the request and record the delay."""
+        if self.limiter is None:
+            return
+        priority = OPERATION_PRIORITIES.get(operation, Priority.POLLING)
+        delay = self.limiter.acquire(priority)
+        self.metrics["requests", priority.name] += 1
+        self.metrics["queue_delay", priority.name] += delay
+
+    def _request(self, url, method, hedge_after, kwargs):
+        """Send a request, hedged by a second one for slow GET requests."""
+        def send():
+            self.metrics["http_requests"] += 1
+            response = getattr(self.session or requests, method)(url, **kwargs)
             response.raise_for_status()
-        except requests.exceptions.RequestException as ex:
-            if log_errors:
-                _LOGGER.error("HTTPError: %s", str(ex))
-            if raise_errors:
-                raise
-        else:
             return response
 
-    def _post_soap_request(self, url, params, action):
-        headers = {
-            'SOAPACTION': f'"{action}"',
-            "Content-Type": "text/xml"
-        }
+        # a second request would defeat the purpose of a rate limit
+        if hedge_after is None or method != HttpMethod.GET.value or self.limiter:
+            return send()
+
+        # both requests run on the executor, the caller waits for the first
+        # response and cannot be blocked by the slow one
+        executor = self.hedge_executor
+        first = executor.submit(send)
+        done, _ = wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+
+        self.metrics["hedged", urlparse(url).path] += 1
+        error = None
+        for future in as_completed([first, executor.submit(send)]):
+            try:
+                return future.result()
+            except requests.exceptions.RequestException as ex:
+                error = ex
+        raise error
+
+    def _post_soap_request(self, url, params, action, operation="status"):
+        headers = _soap_headers(action)
 
         data = f"""<?xml version='1.0' encoding='utf-8'?>
                     <SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"
@@ -665,7 +1200,8 @@ class SonyDevice:
                         </SOAP-ENV:Body>
                     </SOAP-ENV:Envelope>"""
         response = self._send_http(
-            url, method=HttpMethod.POST, headers=headers, data=data)
+            url, method=HttpMethod.POST, headers=headers, data=data,
+            operation=operation)
         if response:
             return response.content.decode("utf-8")
         return False
@@ -678,20 +1214,23 @@ class SonyDevice:
         action = "urn:schemas-sony-com:service:IRCC:1#X_SendIRCC"
 
         content = self._post_soap_request(
-            url=self.control_url, params=data, action=action)
+            url=self.control_url, params=data, action=action,
+            operation="keypress")
         return content
 
+    def send_command(self, name):
+        """Send the command with the given name to the device."""
+        self._send_command(name)
+
     def _send_command(self, name):
         if not self.commands:
             self.init_device()
 
         if self.commands:
             if name in self.commands:
-                self._send_req_ircc(self.commands[name].value)
-            else:
-                raise ValueError(f'Unknown command: {name}')
-        else:
-            raise ValueError('Failed to read command list from device.')
+                return self._send_req_ircc(self.commands[name].value)
+            raise ValueError(f'Unknown command: {name}')
+        raise ValueError('Failed to read command list from device.')
 
     def _get_action(self, name):
         """Get the action object for the action with the given name"""
@@ -707,7 +1246,8 @@ class SonyDevice:
             self._send_http(
                 registration_action.url,
                 method=HttpMethod.GET,
-                raise_errors=True)
+                raise_errors=True,
+                operation="registration")
             # set the pin to something to make sure init_device is called
             self.pin = 9999
         except requests.exceptions.RequestException:
@@ -725,7 +1265,8 @@ class SonyDevice:
     def _register_v3(self, registration_action):
         try:
             self._send_http(registration_action.url,
-                            method=HttpMethod.GET, raise_errors=True)
+                            method=HttpMethod.GET, raise_errors=True,
+                            operation="registration")
         except requests.exceptions.RequestException as ex:
             return self._handle_register_error(ex)
         return AuthenticationResult.SUCCESS
@@ -734,9 +1275,7 @@ class SonyDevice:
         authorization = self._create_api_json("actRegister")
 
         try:
-            headers = {
-                "Content-Type": "application/json"
-            }
+            headers = JSON_HEADERS
 
             if self.pin is None:
                 auth_pin = ''
@@ -748,7 +1287,8 @@ class SonyDevice:
                                        headers=headers,
                                        auth=('', auth_pin),
                                        data=json.dumps(authorization),
-                                       raise_errors=True)
+                                       raise_errors=True,
+                                       operation="registration")
 
         except requests.exceptions.RequestException as ex:
             return self._handle_register_error(ex)
@@ -762,8 +1302,28 @@ class SonyDevice:
 
     def _add_headers(self):
         """Add headers which all devices need"""
-        self.headers['X-CERS-DEVICE-ID'] = self.client_id
-        self.headers['X-CERS-DEVICE-INFO'] = self.client_id
+        self._update_headers({
+            'X-CERS-DEVICE-ID': self.client_id,
+            'X-CERS-DEVICE-INFO': self.client_id,
+        })
+
+    def _update_headers(self, headers):
+        """Replace the headers by a new dict containing the given ones.
+
+        The dict is never modified in place, which allows requests to share
+        a read only view of it.
+        """
+        headers = {**self.headers, **headers}
+        if headers != self.headers:
+            self.headers = headers
+
+    def _request_headers(self):
+        """Get a read only view of the headers, built once per change."""
+        headers, view = self._header_view or (None, None)
+        if headers is not self.headers:
+            view = MappingProxyType(self.headers)
+            self._header_view = (self.headers, view)
+        return view
 
     def _recreate_auth_cookie(self):
         """Recreate auth cookie for all urls
@@ -771,14 +1331,94 @@ class SonyDevice:
         Default cookie is for URL/sony.
         For some commands we need it for the root path
         """
-        # pylint: disable=abstract-class-instantiated
-        cookies = requests.cookies.RequestsCookieJar()
-        cookies.set("auth", self.cookies.get("auth"))
+        self._renew_expiring_auth()
+        auth = self.cookies.get("auth")
+        cookies = self._root_cookies
+        if cookies is None or cookies.get("auth") != auth:
+            # pylint: disable=abstract-class-instantiated
+            cookies = requests.cookies.RequestsCookieJar()
+            cookies.set("auth", auth)
+            self._root_cookies = cookies
         return cookies
 
+    def _renew_expiring_auth(self):
+        expires = self.auth_expires
+        if expires is None or expires - time.time() > AUTH_REFRESH_MARGIN:
+            return
+        if time.monotonic() < self._auth_retry_at:
+            return
+        if not self.refresh_authentication():
+            self._auth_retry_at = time.monotonic() + AUTH_RETRY_INTERVAL
+
+    def refresh_authentication(self):
+        """Renew the auth cookie of a v4 device using the stored pin.
+
+        Returns True on success, False if it failed or is not supported.
+        """
+        registration_action = self._auth_registration_action()
+        if registration_action is None:
+            return False
+
+        expires = self.auth_expires
+        with self._auth_lock:
+            if self.auth_expires != expires:
+                # renewed by another thread while waiting
+                return True
+            result = self._register_v4(registration_action)
+
+        if result is AuthenticationResult.SUCCESS:
+            self.metrics["auth_refreshes"] += 1
+            _LOGGER.debug("Renewed auth cookie of %s", self.host)
+            return True
+        self.metrics["auth_refresh_failures"] += 1
+        _LOGGER.warning("Failed to renew auth cookie of %s", self.host)
+        return False
+
+    def start_auth_refresh(self, margin=AUTH_REFRESH_MARGIN):
+        """Renew the auth cookie in the background before it expires.
+
+        Returns False if the expiry of the cookie is unknown or if the
+        device does not support it.
+        """
+        self.stop_auth_refresh()
+        expires = self.auth_expires
+        if expires is None or self._auth_registration_action() is None:
+            return False
+        self._schedule_auth_refresh(expires - margin - time.time(), margin)
+        return True
+
+    def stop_auth_refresh(self):
+        """Stop renewing the auth cookie in the background."""
+        timer = self._auth_timer
+        if timer is not None:
+            timer.cancel()
+            self._auth_timer = None
+
+    def _auth_registration_action(self):
+        """Get the registration action if the auth cookie can be renewed."""
+        registration_action = self.actions.get("register")
+        if registration_action is None or registration_action.mode != 4 or not self.pin:
+            return None
+        return registration_action
+
+    def _schedule_auth_refresh(self, delay, margin):
+        timer = threading.Timer(max(delay, 0), self._background_auth_refresh, args=(margin,))
+        timer.daemon = True
+        self._auth_timer = timer
+        timer.start()
+
+    def _background_auth_refresh(self, margin):
+        if self.refresh_authentication():
+            self.start_auth_refresh(margin)
+        else:
+            # e.g. the device is switched off
+            self._schedule_auth_refresh(AUTH_RETRY_INTERVAL, margin)
+
     def _set_value(self, attribute, value):
         if not hasattr(self, attribute):
             setattr(self, attribute, value)
+        elif value and self._refreshing:
+            setattr(self, attribute, value)
         elif value and not getattr(self, attribute):
             setattr(self, attribute, value)
 
@@ -889,42 +1529,183 @@ class SonyDevice:
     def get_power_status(self):
         """Check if the device is online."""
         if self.api_version < 4:
-            url = self.actionlist_url
-            try:
-                self._send_http(url, HttpMethod.GET,
-                                log_errors=False, raise_errors=True)
-            except requests.exceptions.RequestException as ex:
+            return self._probe_legacy(log_errors=True)
+        status = self._get_power_status_v4()
+        return status is not None and status != "off"
+
+    def _probe_legacy(self, log_errors=False, operation="probe"):
+        # the action list is not known before the device was initialized
+        url = self.actionlist_url or self.dmr_url
+        try:
+            self._send_http(url, HttpMethod.GET,
+                            log_errors=False, raise_errors=True,
+                            operation=operation)
+        except requests.exceptions.RequestException as ex:
+            if log_errors:
                 _LOGGER.debug(ex)
-                return False
-            return True
+            return False
+        return True
+
+    def _get_power_status_v4(self, log_errors=True, operation="probe"):
+        """Get the power status of a v4 device, None if it is not reachable."""
         try:
-            resp = self._send_http(urljoin(self.base_url, "system"),
-                                   HttpMethod.POST,
-                                   json=self._create_api_json(
-                                       "getPowerStatus"))
-            if not resp:
-                return False
-            json_data = resp.json()
-            if not json_data.get('error'):
-                power_data = json_data.get('result')[0]
-                return power_data.get('status') != "off"
-        except requests.RequestException:
-            pass
-        return False
+            result = self.webapi.call("system", "getPowerStatus",
+                                      log_errors=log_errors, operation=operation)
+        except (WebApiError, requests.RequestException):
+            return None
+        return result[0].get('status')
+
+    def _probe_power_status(self):
+        """Get the power status using the cheapest request available."""
+        if self.api_version < 4:
+            # legacy devices do not answer at all while in standby
+            return "active" if self._probe_legacy(operation="power") else None
+        return self._get_power_status_v4(log_errors=False, operation="power")
+
+    def _commands_ready(self):
+        """Make sure the command list is loaded from a device which is on."""
+        if not self.commands:
+            self.init_device()
+        # v4 devices do not provide their commands without registration
+        return bool(self.commands) or (self.api_version > 3 and not self.pin)
 
-    def start_app(self, app_name):
-        """Start an app by name"""
-        # sometimes device does not start app if already running one
-        self.home()
+    def start_app(self, app_name, home=None, wait=False, timeout=10, interval=0.25):
+        # pylint: disable=too-many-arguments,redefined-outer-name
+        """Start an app by name.
 
+        Home is sent first if another app might be in the foreground, pass
+        home to always or never send it. If wait is set the app is polled
+        until it is running and the seconds until then are returned, None
+        if it was not running within timeout seconds.
+        """
+        start = time.monotonic()
+        self._load_applist()
+        if app_name not in self.apps:
+            # the app might have been installed after reading the list
+            self._load_applist(newer_than=start)
+        app = self.apps[app_name]
+
+        if home is None:
+            home = self._needs_home(app_name)
+        if home:
+            # sometimes device does not start app if already running one
+            self.home()
+
+        url = self._dial_app_url(app)
         if self.api_version < 4:
-            url = f"{self.app_url}/apps/{self.apps[app_name].id}"
             data = f"LOCATION: {url}/run"
-            self._send_http(url, HttpMethod.POST, data=data)
+            self._send_http(url, HttpMethod.POST, data=data,
+                            operation="keypress")
         else:
-            url = f'http://{self.host}/DIAL/apps/{self.apps[app_name].id}'
             self._send_http(url, HttpMethod.POST,
-                            cookies=self._recreate_auth_cookie())
+                            cookies=self._recreate_auth_cookie(),
+                            operation="keypress")
+        self._foreground_app = app_name
+
+        if not wait:
+            return None
+        while True:
+            if self._get_dial_state(app) == "running":
+                latency = time.monotonic() - start
+                _LOGGER.debug("%s running after %.2fs", app_name, latency)
+                return latency
+            remaining = start + timeout - time.monotonic()
+            if remaining <= 0:
+                _LOGGER.debug("%s not running within %ss", app_name, timeout)
+                return None
+            time.sleep(min(interval, remaining))
+
+    def get_app_state(self, app_name):
+        """Get the state of an app, e.g. running or stopped.
+
+        Returns None if the device does not report it.
+        """
+        app = self.apps.get(app_name)
+        if app is None:
+            return None
+        return self._get_dial_state(app)
+
+    def _dial_app_url(self, app):
+        if self.api_version < 4:
+            return f"{self.app_url}/apps/{app.id}"
+        return f'http://{self.host}/DIAL/apps/{app.id}'
+
+    def _get_dial_state(self, app):
+        kwargs = {}
+        if self.api_version >= 4:
+            kwargs["cookies"] = self._recreate_auth_cookie()
+        response = self._send_http(self._dial_app_url(app), HttpMethod.GET,
+                                   log_errors=False, operation="status", **kwargs)
+        if not response:
+            return None
+        try:
+            state = find_in_xml(response.text, [f"{URN_DIAL}state"])
+        except xml.etree.ElementTree.ParseError:
+            return None
+        return state.text if state is not None else None
+
+    def _needs_home(self, app_name):
+        """Check if another app might be in the foreground."""
+        if self._foreground_app == app_name:
+            # another app might have been started with the remote since
+            return self._get_dial_state(self.apps[app_name]) != "running"
+        # an app stopped by this object might have been replaced by another
+        # one, only an input playing shows that no app is in front
+        return not self._input_in_front()
+
+    def _input_in_front(self):
+        """Check if a v4 device is showing an input like tv or hdmi."""
+        if self.api_version < 4:
+            return False
+        try:
+            result = self.webapi.call("avContent", "getPlayingContentInfo",
+                                      operation="status")
+        except (WebApiError, requests.exceptions.RequestException):
+            # e.g. Illegal State while an app is in front
+            return False
+        return bool(result and result[0].get("uri"))
+
+    def power_on(self, broadcast=None, deadline=60, wol_packets=3,
+                 probe_delay=0.25, max_probe_delay=4):
+        # pylint: disable=too-many-arguments
+        """Power the device on and wait until it accepts commands.
+
+        A burst of wake on lan packets is sent, afterwards the device is
+        probed with exponential backoff until it is ready. The power key is
+        only sent to v4 devices which report to be in standby, sending it
+        to a device which is still booting would turn it off again.
+        Returns the seconds until the device was ready or None if it was
+        not ready within deadline seconds.
+        """
+        start = time.monotonic()
+        end = start + deadline
+        for _ in range(wol_packets):
+            self.wakeonlan(broadcast)
+
+        # the deadline also bounds reading the device description
+        with self._deadline(end):
+            return self._wait_until_ready(start, end, probe_delay, max_probe_delay)
+
+    def _wait_until_ready(self, start, end, probe_delay, max_probe_delay):
+        power_key_sent = False
+        delay = probe_delay
+        while True:
+            status = self._probe_power_status()
+            if status == "active" and self._commands_ready():
+                time_to_ready = time.monotonic() - start
+                _LOGGER.debug("%s ready after %.2fs", self.host, time_to_ready)
+                return time_to_ready
+
+            if status == "standby" and self.commands and not power_key_sent:
+                self._send_command('Power')
+                power_key_sent = True
+
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                _LOGGER.debug("%s not ready within %.2fs", self.host, end - start)
+                return None
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_probe_delay)
 
     def power(self, power_on, broadcast=None):
         """Powers the device on or shuts it off."""
@@ -935,21 +1716,151 @@ class SonyDevice:
                 # Try using the power on command incase the WOL doesn't work
                 self._send_command('Power')
         else:
-            self._send_command('Power')
+            # v4 devices only offer PowerOff, both channels only turn them off
+            self._run_on_channel(self._channel_operations(
+                'Power', "system", "setPowerStatus", [{"status": False}]),
+                idempotent=True)
 
     def get_apps(self):
-        """Get the apps from the stored dict."""
+        """Get the names of the apps, the list is read if outdated."""
+        self._load_applist()
         return list(self.apps.keys())
 
+    def get_icon(self, index=0, cache=None, revalidate=False):
+        """Get the image data of a device icon, None if not available.
+
+        Icons are cached in a cache shared by all devices unless another
+        cache is given.
+        """
+        if not self.icons or index >= len(self.icons):
+            return None
+        cache = DEFAULT_ICON_CACHE if cache is None else cache
+        return cache.get(self, self.icons[index], revalidate)
+
+    def get_app_icon(self, app_name, cache=None, revalidate=False):
+        """Get the image data of the icon of an app, None if not available."""
+        app = self.apps.get(app_name)
+        if app is None or not app.url:
+            return None
+        cache = DEFAULT_ICON_CACHE if cache is None else cache
+        return cache.get(self, app.url, revalidate)
+
+    def get_resource(self, url, headers=None):
+        """Get a resource like an icon, raises RequestException on failure.
+
+        The request uses the timeouts, retries and limiter of the device,
+        headers are added to the ones of the device.
+        """
+        return self._send_http(url, HttpMethod.GET,
+                               headers={**self._request_headers(), **(headers or {})},
+                               log_errors=False, raise_errors=True,
+                               operation="description")
+
+    def get_sources(self, scheme):
+        """Get the sources of a scheme like tv or extInput, v4 devices only."""
+        return self.webapi.call("avContent", "getSourceList", [{"scheme": scheme}],
+                                operation="status")[0]
+
+    def iter_content(self, uri, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate over the content of a source, e.g. the channels of tv:dvbt.
+
+        The list is read page by page while iterating, v4 devices only.
+        """
+        return self.webapi.iter_pages("avContent", "getContentList", {"uri": uri},
+                                      page_size, version="1.5")
+
+    def _channel_operations(self, command, service=None, method=None, params=None):
+        """Get the functions sending an operation over each available channel."""
+        operations = {CHANNEL_IRCC: lambda: self._send_command(command)}
+        if self.api_version > 3 and method:
+            operations[CHANNEL_WEBAPI] = lambda: self._call_webapi(service, method, params)
+        return operations
+
+    def _call_webapi(self, service, method, params):
+        try:
+            self.webapi.call(service, method, params, operation="keypress")
+        except (WebApiError, requests.exceptions.RequestException) as ex:
+            _LOGGER.debug("%s failed: %s", method, ex)
+            return False
+        return True
+
+    def _rank_channels(self, channels, idempotent=False):
+        """Sort channels, healthy and fast ones first.
+
+        Only idempotent operations explore the channel ranked second, they
+        fall back to the best one if it fails.
+        """
+        if self.channel in channels:
+            return [self.channel]
+
+        stats = self.channel_stats
+
+        def sort_key(channel):
+            stat = stats.get(channel)
+            if stat is None:
+                # channels without statistics are tried first
+                return False, 0
+            return stat.success_rate < 0.5, stat.latency
+
+        ranked = sorted(channels, key=sort_key)
+        total = sum(stat.requests for stat in stats.values())
+        explore = idempotent and len(ranked) > 1 and total
+        if explore and total % CHANNEL_EXPLORE_EVERY == 0:
+            ranked[0], ranked[1] = ranked[1], ranked[0]
+        return ranked
+
+    def _run_on_channel(self, operations, idempotent=False):
+        """Run an operation over the best channel.
+
+        Operations maps channels to functions returning a true value on
+        success. Only idempotent operations fall back to the other
+        channels, a keypress which timed out might have reached the device
+        and must not be sent twice. The error of the last channel used is
+        raised if it failed.
+        """
+        error = None
+        for channel in self._rank_channels(list(operations), idempotent):
+            start = time.monotonic()
+            error = None
+            try:
+                success = bool(operations[channel]())
+            except (requests.exceptions.RequestException, ValueError) as ex:
+                _LOGGER.debug("Failed to use %s channel: %s", channel, ex)
+                error = ex
+                success = False
+            self._record_channel(channel, time.monotonic() - start, success)
+            if success:
+                return True
+            if not idempotent:
+                break
+        if error is not None:
+            raise error
+        return False
+
+    def _record_channel(self, channel, latency, success):
+        stats = self.channel_stats.get(channel)
+        if stats is None:
+            stats = ChannelStats(latency, float(success), 1)
+        else:
+            stats = ChannelStats(
+                stats.latency + CHANNEL_SMOOTHING * (latency - stats.latency),
+                stats.success_rate + CHANNEL_SMOOTHING * (success - stats.success_rate),
+                stats.requests + 1)
+        self.channel_stats[channel] = stats
+
     def volume_up(self):
         # pylint: disable=invalid-name
         """Send the command 'VolumeUp' to the connected device."""
-        self._send_command('VolumeUp')
+        self._run_on_channel(self._channel_operations(
+            'VolumeUp', "audio", "setAudioVolume",
+            [{"target": "speaker", "volume": "+1"}]))
 
     def volume_down(self):
         # pylint: disable=invalid-name
         """Send the command 'VolumeDown' to the connected device."""
-        self._send_command('VolumeDown')
+        self._run_on_channel(self._channel_operations(
+            'VolumeDown', "audio", "setAudioVolume",
+            [{"target": "speaker", "volume": "-1"}]))
 
     def mute(self):
         # pylint: disable=invalid-name
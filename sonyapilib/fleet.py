@@ -0,0 +1,431 @@
+"""Helpers to control many devices at once."""
+import heapq
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import requests
+import wakeonlan
+
+from sonyapilib.device import SonyDevice
+from sonyapilib.limiter import RateLimiter
+from sonyapilib.store import DeviceStore
+
+_LOGGER = logging.getLogger(__name__)
+
+WOL_PORT = 9
+# hosts whose connections are kept alive, requests closes the least recently used
+MAX_POOLED_HOSTS = 1024
+
+FleetResult = namedtuple("FleetResult", ["device", "result", "error"])
+DeviceState = namedtuple("DeviceState", ["power", "playing"])
+
+
+def load_devices(source, max_workers=8):
+    """Decode many stored device configurations.
+
+    Source is either a directory containing json files, an iterable of
+    json strings or a DeviceStore. The files of a directory are read in
+    parallel, decoding is CPU bound and is not sped up by threads.
+    The devices are not initialized.
+    Returns the list of devices and a dict containing the exception for
+    every file name or index which could not be loaded.
+    """
+    if isinstance(source, DeviceStore):
+        return source.load_all(), {}
+
+    if isinstance(source, (str, os.PathLike)):
+        names = sorted(os.path.join(source, name) for name in os.listdir(source)
+                       if name.endswith(".json"))
+
+        def read_file(name):
+            with open(name, encoding="utf-8") as config:
+                return config.read()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            configs = [executor.submit(read_file, name) for name in names]
+
+        def read(future):
+            return future.result()
+    else:
+        configs = list(source)
+        names = range(len(configs))
+
+        def read(data):
+            return data
+
+    devices = []
+    failures = {}
+    for name, config in zip(names, configs):
+        try:
+            device = SonyDevice.load_from_json(read(config), init=False)
+            if not isinstance(device, SonyDevice):
+                raise ValueError("Configuration does not contain a device")
+            devices.append(device)
+        except Exception as ex:  # pylint: disable=broad-except
+            _LOGGER.error("Failed to load device %s: %s", name, ex)
+            failures[name] = ex
+    return devices, failures
+
+
+class WakeOnLan():
+    # pylint: disable=too-few-public-methods
+    """Send wake on lan packets to many devices at once.
+
+    The magic packets are created once and grouped by the broadcast
+    address of the devices, every broadcast domain uses a single socket.
+    """
+
+    def __init__(self, devices, port=WOL_PORT):
+        """Create the magic packets for all given devices."""
+        self.port = port
+        self.packets = {}
+        self.missing_mac = []
+
+        for device in devices:
+            if not device.mac:
+                self.missing_mac.append(device)
+                continue
+            try:
+                packet = wakeonlan.create_magic_packet(device.mac)
+            except ValueError:
+                _LOGGER.warning("Invalid mac %s for %s", device.mac, device.host)
+                self.missing_mac.append(device)
+                continue
+
+            broadcast = device.broadcast_address or "255.255.255.255"
+            self.packets.setdefault(broadcast, []).append(packet)
+
+    def send(self, repeats=3, interval=0.05):
+        """Send all packets repeats times.
+
+        Returns the devices which cannot be woken up because no valid
+        mac is known for them.
+        """
+        for broadcast, packets in self.packets.items():
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                    for repeat in range(repeats):
+                        if repeat and interval:
+                            time.sleep(interval)
+                        for packet in packets:
+                            sock.sendto(packet, (broadcast, self.port))
+            except OSError as ex:
+                _LOGGER.error("Failed to send wake on lan to %s: %s", broadcast, ex)
+
+        return self.missing_mac
+
+
+class SonyDeviceFleet():
+    # pylint: disable=too-many-instance-attributes
+    """Manage many devices sharing one worker pool and one connection pool.
+
+    Bulk operations run on at most max_workers threads, and at most
+    max_per_device operations run on the same device at once.
+    Their results are yielded as FleetResult in the order they complete.
+    """
+
+    def __init__(self, devices=(), max_workers=16, max_per_device=1,
+                 timeouts=None, retries=None, rate_limit=None):
+        # pylint: disable=too-many-arguments
+        """Init the fleet with the given devices.
+
+        Timeouts and retries map operations to the TimeoutPolicy and
+        RetryPolicy used by all devices which do not set their own. With
+        rate_limit each device gets a RateLimiter allowing that many
+        requests per second.
+        """
+        devices = list(devices)
+        self.devices = {}
+        self.max_per_device = max_per_device
+        self.timeouts = timeouts or {}
+        self.retries = retries or {}
+        self.rate_limit = rate_limit
+        self.session = requests.Session()
+        # one pool per host, each keeping as many connections as requests
+        # may run at once on a device
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max(len(devices), MAX_POOLED_HOSTS),
+            pool_maxsize=max_per_device)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # a hedged read of every worker runs two requests
+        self._hedge_executor = ThreadPoolExecutor(
+            max_workers=2 * max_workers, thread_name_prefix="sonyapilib-hedge")
+        self._device_limits = {}
+
+        for device in devices:
+            self.add(device)
+
+    def __enter__(self):
+        """Use the fleet as context manager."""
+        return self
+
+    def __exit__(self, *args):
+        """Release the worker and connection pool."""
+        self.close()
+
+    def add(self, device):
+        """Add a device, it will use the connection pool of the fleet."""
+        device.session = self.session
+        device.hedge_executor = self._hedge_executor
+        # policies set on the device win over the defaults of the fleet
+        for operation, policy in self.timeouts.items():
+            device.timeouts.setdefault(operation, policy)
+        for operation, policy in self.retries.items():
+            device.retries.setdefault(operation, policy)
+        if self.rate_limit and device.limiter is None:
+            device.limiter = RateLimiter(self.rate_limit)
+        self.devices[device.host] = device
+        self._device_limits[device.host] = threading.BoundedSemaphore(
+            self.max_per_device)
+
+    def remove(self, host):
+        """Remove a device from the fleet and return it."""
+        device = self.devices.pop(host)
+        self._device_limits.pop(host)
+        device.session = None
+        device.hedge_executor = None
+        return device
+
+    def close(self):
+        """Release the worker and connection pool."""
+        self._executor.shutdown(wait=False)
+        self._hedge_executor.shutdown(wait=False)
+        self.session.close()
+
+    def load(self, source, refresh=True, progress=None):
+        """Load stored devices into the fleet, see load_devices.
+
+        The devices are usable right away. If refresh is set they are
+        initialized in the background by the worker pool, progress is
+        called with the number of finished devices, the total number,
+        the device and the exception if its initialization failed.
+        Returns the loaded devices and the failures of load_devices.
+        """
+        devices, failures = load_devices(source)
+        for device in devices:
+            self.add(device)
+        if not refresh:
+            return devices, failures
+
+        lock = threading.Lock()
+        finished = []
+
+        def done(future, device):
+            with lock:
+                finished.append(device)
+                count = len(finished)
+            if progress:
+                progress(count, len(devices), device, future.exception())
+
+        for device in devices:
+            future = self.submit(lambda device: device.init_device(), device.host)
+            future.add_done_callback(lambda future, device=device: done(future, device))
+        return devices, failures
+
+    def submit(self, function, host):
+        """Call function with the device in the worker pool and return the future."""
+        return self._executor.submit(self._run, function, self.devices[host])
+
+    def run_all(self, function, hosts=None, timeout=None):
+        """Call function with every device and yield the results as they complete.
+
+        If hosts is given only these devices are used. Devices which are
+        not done within timeout seconds are yielded with a TimeoutError,
+        their operation finishes in the background.
+        """
+        hosts = self.devices if hosts is None else hosts
+        devices = [self.devices[host] for host in hosts]
+        futures = {self._executor.submit(self._run, function, device): device
+                   for device in devices}
+        return self._results(futures, timeout)
+
+    def init_all(self, timeout=None):
+        """Initialize all devices."""
+        return self.run_all(lambda device: device.init_device(), timeout=timeout)
+
+    def status_all(self, timeout=None):
+        """Get the power status of all devices."""
+        return self.run_all(lambda device: device.get_power_status(), timeout=timeout)
+
+    def send_all(self, command, timeout=None):
+        """Send the command with the given name to all devices."""
+        return self.run_all(lambda device: device.send_command(command), timeout=timeout)
+
+    def _run(self, function, device):
+        with self._device_limits[device.host]:
+            return function(device)
+
+    @staticmethod
+    def _results(futures, timeout):
+        pending = set(futures)
+        try:
+            for future in as_completed(futures, timeout):
+                pending.discard(future)
+                try:
+                    yield FleetResult(futures[future], future.result(), None)
+                except Exception as ex:  # pylint: disable=broad-except
+                    yield FleetResult(futures[future], None, ex)
+        except FutureTimeoutError:
+            for future in pending:
+                future.cancel()
+                yield FleetResult(futures[future], None, TimeoutError(
+                    f"Operation did not finish within {timeout}s"))
+
+
+class PollingScheduler():
+    # pylint: disable=too-many-instance-attributes
+    """Poll the state of all devices in a fleet at adaptive intervals.
+
+    Devices which are playing are polled more often than devices which are
+    on, devices which are off are polled rarely. Devices which changed
+    their state recently are polled most often. Polls are spread by a
+    random jitter, and the polls send at most max_rate requests per second
+    on average. Each poll is charged for the requests it sent, including
+    retries.
+    Subscribers are called with the device, its old and its new state
+    whenever the state of a device changed.
+    """
+
+    def __init__(self, fleet, intervals=None, change_window=30,
+                 max_rate=10, jitter=0.1):
+        # pylint: disable=too-many-arguments
+        """Init the scheduler, intervals override the default poll intervals."""
+        self.fleet = fleet
+        self.intervals = {
+            "changed": 2,
+            "playing": 5,
+            "on": 15,
+            "off": 60,
+        }
+        self.intervals.update(intervals or {})
+        self.change_window = change_window
+        self.max_rate = max_rate
+        self.jitter = jitter
+        self.states = {}
+
+        self._changed_at = {}
+        self._queue = []
+        self._subscribers = []
+        self._tokens = max_rate
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback):
+        """Register a callback for state changes and return a function to unsubscribe."""
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback)
+
+    def start(self):
+        """Start polling, the first polls are spread over the on interval."""
+        now = time.monotonic()
+        hosts = list(self.fleet.devices)
+        with self._lock:
+            self._queue = [
+                (now + index * self.intervals["on"] / max(len(hosts), 1), host)
+                for index, host in enumerate(hosts)]
+            heapq.heapify(self._queue)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def schedule(self, host, delay=0):
+        """Schedule a poll of a device, e.g. after it was added to the fleet."""
+        with self._lock:
+            heapq.heappush(self._queue, (time.monotonic() + delay, host))
+
+    def stop(self):
+        """Stop polling, running polls are finished."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def interval(self, host, now=None):
+        """Get the interval in which the device is polled."""
+        now = time.monotonic() if now is None else now
+        state = self.states.get(host)
+        if now - self._changed_at.get(host, -self.change_window) < self.change_window:
+            return self.intervals["changed"]
+        if state is None or not state.power:
+            return self.intervals["off"]
+        if state.playing == "PLAYING":
+            return self.intervals["playing"]
+        return self.intervals["on"]
+
+    def poll(self, host):
+        """Poll the state of a device and schedule its next poll."""
+        device = self.fleet.devices.get(host)
+        if device is None:
+            return None
+
+        sent = device.metrics["http_requests"]
+        try:
+            power = device.get_power_status()
+            state = DeviceState(power, device.get_playing_status() if power else "OFF")
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Failed to poll %s", host)
+            state = self.states.get(host)
+        # the token taken to start the poll paid for its first request
+        self._charge(device.metrics["http_requests"] - sent - 1)
+
+        now = time.monotonic()
+        previous = self.states.get(host)
+        if state is not None:
+            self.states[host] = state
+        if previous is not None and state != previous:
+            self._changed_at[host] = now
+            for callback in list(self._subscribers):
+                try:
+                    callback(device, previous, state)
+                except Exception:  # pylint: disable=broad-except
+                    _LOGGER.exception("Error in polling subscriber")
+
+        interval = self.interval(host, now)
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        with self._lock:
+            heapq.heappush(self._queue, (now + interval, host))
+        return state
+
+    def _charge(self, requests_sent):
+        with self._lock:
+            self._tokens -= requests_sent
+
+    def _take_token(self, now):
+        self._tokens = min(self.max_rate, self._tokens + (now - self._refilled) * self.max_rate)
+        self._refilled = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _loop(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                while self._queue and self._queue[0][0] <= now and self._take_token(now):
+                    _, host = heapq.heappop(self._queue)
+                    try:
+                        self.fleet.submit(lambda device: self.poll(device.host), host)
+                    except KeyError:
+                        # the device was removed from the fleet
+                        continue
+                    except RuntimeError:
+                        _LOGGER.debug("Fleet was closed, stop polling")
+                        self._stop.set()
+                        break
+                wait_time = self._queue[0][0] - now if self._queue else 1
+                if self._tokens < 1:
+                    wait_time = (1 - self._tokens) / self.max_rate
+            self._stop.wait(min(max(wait_time, 0.001), 1))
@@ -0,0 +1,149 @@
+"""Cache for device and app icons."""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlparse
+
+import requests
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+IconEntry = namedtuple("IconEntry", ["content", "etag", "last_modified"])
+
+
+class IconCache:
+    """Least recently used cache for icons, bounded by the size of the images.
+
+    Icons served by a device are shared between devices of the same model,
+    icons from other servers are cached by their url. If a directory is
+    given the icons are also stored on disk and survive restarts.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, directory=None):
+        """Init the cache."""
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        """Get the number of icons in memory."""
+        return len(self._entries)
+
+    @staticmethod
+    def key(device, url):
+        """Get the key of an icon of the given device."""
+        parsed = urlparse(url)
+        if parsed.hostname != device.host or not device.model_name:
+            return url
+        return f"{device.model_name}:{parsed.port}{parsed.path}"
+
+    def get(self, device, url, revalidate=False):
+        """Get the content of an icon, it is only requested if not cached.
+
+        With revalidate a conditional request checks if the cached icon
+        is still up to date. Returns None if the icon is not available.
+        """
+        key = self.key(device, url)
+        entry = self._lookup(key)
+        if entry is not None and not revalidate:
+            return entry.content
+
+        headers = {}
+        if entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+
+        try:
+            response = device.get_resource(url, headers)
+        except requests.exceptions.RequestException as ex:
+            _LOGGER.debug("Failed to get icon %s: %s", url, ex)
+            return entry.content if entry is not None else None
+
+        if response.status_code == 304 and entry is not None:
+            return entry.content
+
+        entry = IconEntry(response.content, response.headers.get("ETag"),
+                          response.headers.get("Last-Modified"))
+        self._store(key, entry)
+        return entry.content
+
+    def clear(self):
+        """Remove all icons from memory, the files on disk are kept."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        entry = self._read(key)
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def _store(self, key, entry):
+        self._remember(key, entry)
+        self._write(key, entry)
+
+    def _remember(self, key, entry):
+        size = len(entry.content)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.content)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.content)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def _read(self, key):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as content_file:
+                content = content_file.read()
+            with open(f"{path}.json", encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+        return IconEntry(content, meta.get("etag"), meta.get("last_modified"))
+
+    def _write(self, key, entry):
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            # write to a temporary file first, a reader never sees partial data
+            with open(f"{path}.tmp", "wb") as content_file:
+                content_file.write(entry.content)
+            os.replace(f"{path}.tmp", path)
+            with open(f"{path}.json", "w", encoding="utf-8") as meta_file:
+                json.dump({"etag": entry.etag, "last_modified": entry.last_modified},
+                          meta_file)
+        except OSError as ex:
+            _LOGGER.warning("Failed to store icon in %s: %s", self.directory, ex)
+
+
+# shared by all devices unless another cache is passed
+DEFAULT_CACHE = IconCache()
@@ -0,0 +1,70 @@
+"""Limit the rate of requests sent to a device."""
+import heapq
+import itertools
+import threading
+import time
+from enum import IntEnum
+
+
+class Priority(IntEnum):
+    """Priority classes of requests, lower values are served first."""
+
+    KEYPRESS = 0
+    POWER = 1
+    POLLING = 2
+    BACKGROUND = 3
+
+
+class RateLimiter:
+    # pylint: disable=too-few-public-methods
+    # pylint: disable=too-many-instance-attributes
+    """Token bucket limiting the requests per second sent to one device.
+
+    Requests waiting for a token are served by priority, so a keypress
+    never waits behind queued polling requests. Polling and background
+    requests leave reserve tokens in the bucket for keypresses and power
+    requests, a burst of polls does not delay them either.
+    """
+
+    def __init__(self, rate=4, burst=None, reserve=1):
+        """Init the limiter, burst defaults to rate but at least one request."""
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self.reserve = max(0, min(reserve, self.burst - 1))
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, priority=Priority.BACKGROUND):
+        """Wait until a request may be sent, return the seconds waited."""
+        start = time.monotonic()
+        needed = 1 if priority <= Priority.POWER else 1 + self.reserve
+        entry = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    self._refill()
+                    if self._waiting[0] == entry and self._tokens >= needed:
+                        heapq.heappop(self._waiting)
+                        self._tokens -= 1
+                        break
+                    timeout = None
+                    if self._tokens < needed:
+                        timeout = (needed - self._tokens) / self.rate
+                    self._condition.wait(timeout)
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                raise
+            finally:
+                # the next request might be able to go now
+                self._condition.notify_all()
+        return time.monotonic() - start
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
@@ -1,98 +1,556 @@
 """SSDP Implementation"""
-import email
+import asyncio
+import ipaddress
 import logging
 import socket
-from io import StringIO
+import struct
+import threading
+import time
+from enum import Enum
 
 _LOGGER = logging.getLogger(__name__)
 
+SSDP_ADDRESS = ("239.255.255.250", 1900)
+# largest payload a single udp datagram can carry
+MAX_DATAGRAM_SIZE = 65507
+RECEIVE_BUFFER_SIZE = 1024 * 1024
+# used if a device does not announce how long its announcement is valid
+DEFAULT_MAX_AGE = 1800
+NTS_ALIVE = "ssdp:alive"
+NTS_BYEBYE = "ssdp:byebye"
+
+
+class SSDPEvent(Enum):
+    """Define what happened to a service in the registry."""
+
+    ADDED = "added"
+    UPDATED = "updated"
+    REMOVED = "removed"
+
 
 class SSDPResponse:
     # pylint: disable=too-few-public-methods
     """Hold the response of a ssdp request."""
 
     def __init__(self, response):
-        """Init the ssdp response with given data"""
+        """Init the ssdp response with given data.
+
+        The data is either a raw message or the headers parsed from it.
+        """
         if not response:
             return
 
-        # construct a message from the request string
-        message = email.message_from_file(StringIO(response))
-
-        # construct a dictionary containing the headers
-        headers = dict(message.items())
-        if "Location" in headers:
-            self.location = headers["Location"]
-        else:
-            self.location = headers["LOCATION"]
+        if not isinstance(response, dict):
+            _, response = _parse_message(response)
 
-        if "Cache-Control" in headers:
-            self.cache = headers["Cache-Control"].split("=")[1]
-        else:
-            self.cache = headers["CACHE-CONTROL"].split("=")[1]
-
-        self.usn = headers["USN"]
+        self.location = response.get("LOCATION")
+        self.cache = _parse_max_age(response.get("CACHE-CONTROL"))
+        self.usn = response.get("USN")
         # pylint: disable=invalid-name
-        self.st = headers["ST"]
+        # announcements carry the service type as notification type
+        self.st = response.get("ST") or response.get("NT")
+
+    @property
+    def max_age(self):
+        """Return for how many seconds the response is valid."""
+        try:
+            return int(self.cache)
+        except (AttributeError, TypeError, ValueError):
+            return DEFAULT_MAX_AGE
 
     def __repr__(self):
         """Define how string representation looks"""
-        return "<SSDPResponse({location}, {st}, {usn})>"\
-            .format(**self.__dict__)
+        location = getattr(self, "location", None)
+        usn = getattr(self, "usn", None)
+        return f"<SSDPResponse({location}, {getattr(self, 'st', None)}, {usn})>"
+
+
+def _parse_message(data):
+    """Split a single ssdp message into its start line and headers.
+
+    Header names are returned in upper case, so lookups do not depend
+    on the spelling used by the device.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+
+    lines = data.split(b"\n")
+    start = b""
+    if b":" not in lines[0]:
+        start = lines.pop(0)
+
+    headers = {}
+    for line in lines:
+        name, separator, value = line.partition(b":")
+        if not separator:
+            if not line.strip():
+                # an empty line terminates the header section
+                break
+            continue
+        headers[name.strip().upper().decode("ascii", "replace")] = \
+            value.strip().decode("utf-8", "replace")
+    return start.strip().decode("ascii", "replace"), headers
+
+
+def _parse_max_age(cache_control):
+    """Get the max-age directive from a Cache-Control header."""
+    if not cache_control:
+        return None
+    for directive in cache_control.split(","):
+        name, _, value = directive.partition("=")
+        if name.strip().lower() == "max-age":
+            return value.strip()
+    return None
+
+
+def _parse_response(data):
+    """Parse a single datagram into a response.
+
+    Returns None if the datagram is not a valid search response.
+    """
+    status, headers = _parse_message(data)
+    if status.split()[1:2] != ["200"] or \
+            not headers.get("LOCATION") or not headers.get("USN"):
+        _LOGGER.debug("Ignoring invalid ssdp response: %s", data)
+        return None
+
+    return SSDPResponse(headers)
+
+
+def _parse_notify(data):
+    """Parse a single announcement datagram.
+
+    Returns the notification sub type and the announced response.
+    Goodbye messages only carry the USN of the service.
+    """
+    start, headers = _parse_message(data)
+    if not start.startswith("NOTIFY"):
+        return None, None
+
+    nts = headers.get("NTS")
+    if not headers.get("USN") or nts not in (NTS_ALIVE, NTS_BYEBYE) or \
+            (nts == NTS_ALIVE and not headers.get("LOCATION")):
+        _LOGGER.debug("Ignoring invalid ssdp announcement: %s", data)
+        return None, None
+
+    return nts, SSDPResponse(headers)
+
+
+def _create_message(service, mx, address=SSDP_ADDRESS):
+    # pylint: disable=invalid-name
+    """Create a search request for the given service type.
+
+    Unicast requests do not contain a MX header.
+    """
+    lines = [
+        'M-SEARCH * HTTP/1.1',
+        f'HOST: {address[0]}:{address[1]}',
+        'MAN: "ssdp:discover"',
+        f'ST: {service}']
+    if mx is not None:
+        lines.append(f'MX: {mx}')
+    return str.encode("\r\n".join(lines + ['', '']))
+
+
+def _create_socket():
+    """Create the udp socket used to send search requests."""
+    sock = socket.socket(
+        socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                    RECEIVE_BUFFER_SIZE)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    return sock
+
+
+def _receive(sock, send_round, timeout, retries):
+    """Yield the datagrams and their sender until the deadline passed.
+
+    Within `timeout` seconds `send_round` is called `retries` times in
+    evenly spaced rounds to compensate for lost datagrams.
+    """
+    retries = max(retries, 1)
+    interval = timeout / retries
+    start = time.monotonic()
+    deadline = start + timeout
+    next_round = start
+    rounds = 0
+
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            return
+        if rounds < retries and now >= next_round:
+            send_round()
+            rounds += 1
+            next_round = start + rounds * interval
+
+        wait_until = next_round if rounds < retries else deadline
+        sock.settimeout(max(min(wait_until, deadline) - now, 0.001))
+        try:
+            yield sock.recvfrom(MAX_DATAGRAM_SIZE)
+        except socket.timeout:
+            continue
+        except OSError as ex:
+            # e.g. icmp port unreachable reported by some platforms
+            _LOGGER.debug("Error while receiving ssdp responses: %s", ex)
 
 
 class SSDPDiscovery():
-    # pylint: disable=too-few-public-methods
     """Discover devices via the ssdp protocol."""
 
     @staticmethod
-    def _parse_response(data):
+    def discover(service="ssdp:all", timeout=1, retries=5, mx=1,
+                 expected=None, usns=None):
+        # pylint: disable=invalid-name, too-many-arguments
+        """Discovers the ssdp services.
+
+        Discovery runs until `timeout` seconds have passed. Within that
+        deadline `retries` search requests are sent in evenly spaced rounds
+        to compensate for lost datagrams. Responses are deduplicated by
+        their USN. Discovery stops early once `expected` distinct services
+        or all services in `usns` have answered.
+        """
+        message = _create_message(service, mx)
+        pending = set(usns) if usns else set()
+
+        # using a dict to prevent duplicated entries.
         responses = {}
-        lines = ""
-        http_ok = "HTTP/1.1 200 OK"
-        for line in data.split('\r\n'):
-            if http_ok in line and lines:
-                response = SSDPResponse(lines)
-                responses[response.location] = response
-                lines = ""
-            elif http_ok not in line:
-                line_content = line.split(":")
-                if len(line_content) >= 2 and line_content[1]:
-                    lines += line + '\r\n'
+        with _create_socket() as sock:
+            for data, _ in _receive(
+                    sock, lambda: sock.sendto(message, SSDP_ADDRESS),
+                    timeout, retries):
+                response = _parse_response(data)
+                if not response or response.usn in responses:
+                    continue
+                responses[response.usn] = response
+                pending.discard(response.usn)
+
+                if usns and not pending:
+                    break
+                if expected and len(responses) >= expected:
+                    break
+
         return list(responses.values())
 
     @staticmethod
-    def discover(service="ssdp:all", timeout=1, retries=5, mx=3):
-        # pylint: disable=invalid-name
-        """Discovers the ssdp services."""
-        socket.setdefaulttimeout(timeout)
-
-        # fppp
-        host = ("239.255.255.250", 1900)
-        message = "\r\n".join([
-            'M-SEARCH * HTTP/1.1',
-            'HOST: {0}:{1}',
-            'MAN: "ssdp:discover"',
-            'ST: {st}', 'MX: {mx}', '', ''])
-        # using a dict to prevent duplicated entries.
-        for _ in range(0, retries):
-            sock = socket.socket(
-                socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-
-            # msg = DISCOVERY_MSG % dict(service='id1', library=LIB_ID)
-            for _ in range(0, retries):
-                # sending it more than once will
-                # decrease the probability of a timeout
-                sock.sendto(str.encode(message.format(
-                    *host, st=service, mx=mx)), host)
-
-            data = ""
+    def search_hosts(hosts, service="ssdp:all", timeout=0.5, retries=2,
+                     port=SSDP_ADDRESS[1]):
+        # pylint: disable=too-many-arguments, too-many-locals
+        """Send unicast search requests to known hosts in parallel.
+
+        Returns a dict containing the first response of every host,
+        or None if the host did not answer within `timeout` seconds.
+        This is a cheap way to check which devices are alive and
+        whether their description url changed.
+        """
+        addresses = {}
+        for host in hosts:
+            try:
+                addresses.setdefault(socket.gethostbyname(host), []).append(host)
+            except OSError as ex:
+                _LOGGER.debug("Failed to resolve %s: %s", host, ex)
+        responses = dict.fromkeys(hosts)
+
+        def send_round():
+            for address, names in addresses.items():
+                if responses[names[0]]:
+                    continue
+                try:
+                    sock.sendto(_create_message(
+                        service, None, (address, port)), (address, port))
+                except OSError as ex:
+                    _LOGGER.debug("Failed to search %s: %s", address, ex)
+
+        with _create_socket() as sock:
+            for data, sender in _receive(sock, send_round, timeout, retries):
+                names = addresses.get(sender[0])
+                if not names or responses[names[0]]:
+                    continue
+                response = _parse_response(data)
+                for name in names:
+                    responses[name] = response
+                if all(responses[entry[0]] for entry in addresses.values()):
+                    break
+
+        return responses
+
+
+class SSDPDiscoveryCache():
+    """Cache discovery results for as long as their max-age allows.
+
+    Cached responses are returned right away. A search is only sent if a
+    cached response expired, it ends as soon as the expired services
+    answered again. In background mode expired responses are returned as
+    well and revalidated by a background thread.
+    """
+
+    def __init__(self, discovery=None, background=False):
+        """Init the cache on top of the given discovery."""
+        self.discovery = discovery or SSDPDiscovery()
+        self.background = background
+        self._services = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def discover(self, service="ssdp:all", force=False, **kwargs):
+        """Return the services which answer to the given type.
+
+        If force is set a full search is sent regardless of the cache.
+        Other arguments are passed to the discovery.
+        """
+        with self._lock:
+            entries = dict(self._services.get(service, {}))
+        if force or not entries:
+            return self._refresh(service, None, kwargs)
+
+        now = time.monotonic()
+        expired = {usn for usn, (_, expires) in entries.items() if expires <= now}
+        if expired and not self.background:
+            return self._refresh(service, expired, kwargs)
+        if expired:
+            self._refresh_in_background(service, expired, kwargs)
+        return [response for response, _ in entries.values()]
+
+    def clear(self):
+        """Drop all cached responses."""
+        with self._lock:
+            self._services.clear()
+
+    def _refresh_in_background(self, service, expired, kwargs):
+        with self._lock:
+            if service in self._refreshing:
+                return
+            self._refreshing.add(service)
+
+        def refresh():
+            try:
+                self._refresh(service, expired, kwargs)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Failed to revalidate ssdp services")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(service)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _refresh(self, service, expired, kwargs):
+        if expired:
+            kwargs = dict(kwargs, usns=expired)
+        responses = self.discovery.discover(service, **kwargs)
+
+        now = time.monotonic()
+        with self._lock:
+            entries = {}
+            if expired:
+                # services which did not answer in time are dropped
+                entries = {usn: entry for usn, entry
+                           in self._services.get(service, {}).items()
+                           if usn not in expired}
+            for response in responses:
+                entries[response.usn] = (response, now + response.max_age)
+            self._services[service] = entries
+        return [response for response, _ in entries.values()]
+
+
+class _SSDPSearchProtocol(asyncio.DatagramProtocol):
+    """Forward received datagrams into a queue."""
+
+    def __init__(self, queue):
+        """Init the protocol with the queue receiving the datagrams."""
+        self.queue = queue
+
+    def datagram_received(self, data, addr):
+        """Queue a received datagram."""
+        self.queue.put_nowait(data)
+
+    def error_received(self, exc):
+        """Log socket errors, discovery continues until the deadline."""
+        _LOGGER.debug("Error during ssdp discovery: %s", exc)
+
+
+class AsyncSSDPDiscovery():
+    # pylint: disable=too-few-public-methods
+    """Discover devices via the ssdp protocol using asyncio."""
+
+    def __init__(self, address=SSDP_ADDRESS):
+        """Init the discovery, address is where search requests are sent to."""
+        self.address = address
+
+    async def discover(self, services=("ssdp:all",), timeout=1, retries=3, mx=1):
+        # pylint: disable=invalid-name, too-many-locals
+        """Discover the ssdp services and yield each response as it arrives.
+
+        Search requests for all given service types are sent in `retries`
+        evenly spaced rounds within `timeout` seconds.
+        Responses are deduplicated by their USN.
+        """
+        if isinstance(services, str):
+            services = (services,)
+        messages = [_create_message(service, mx, self.address)
+                    for service in services]
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        sock = _create_socket()
+        sock.setblocking(False)
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _SSDPSearchProtocol(queue), sock=sock)
+        sender = loop.create_task(
+            self._send_rounds(transport, messages, timeout, max(retries, 1)))
+
+        deadline = loop.time() + timeout
+        seen = set()
+        try:
             while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
                 try:
-                    data = data + bytes.decode(sock.recv(1024))
-                except socket.timeout:
+                    data = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
                     break
 
-            return SSDPDiscovery._parse_response(data)
+                response = _parse_response(data)
+                if not response:
+                    continue
+                key = response.usn or response.location
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield response
+        finally:
+            sender.cancel()
+            transport.close()
+
+    async def _send_rounds(self, transport, messages, timeout, retries):
+        for _ in range(retries):
+            for message in messages:
+                transport.sendto(message, self.address)
+            await asyncio.sleep(timeout / retries)
+
+
+class SSDPRegistry():
+    """Keep track of all services which are currently alive.
+
+    Services are stored by their USN and expire once the max-age
+    of their latest announcement has passed.
+    Subscribers are called with a SSDPEvent and the affected response.
+    """
+
+    def __init__(self):
+        """Init an empty registry."""
+        self.services = {}
+        self._expires = {}
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """Register a callback for changes and return a function to unsubscribe."""
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback)
+
+    def update(self, response, now=None):
+        """Add or refresh a service announced as alive."""
+        now = time.monotonic() if now is None else now
+        previous = self.services.get(response.usn)
+        self.services[response.usn] = response
+        self._expires[response.usn] = now + response.max_age
+
+        if previous is None:
+            self._notify(SSDPEvent.ADDED, response)
+        elif (previous.location, previous.st) != (response.location, response.st):
+            self._notify(SSDPEvent.UPDATED, response)
+
+    def remove(self, usn):
+        """Remove a service which said goodbye."""
+        response = self.services.pop(usn, None)
+        self._expires.pop(usn, None)
+        if response is not None:
+            self._notify(SSDPEvent.REMOVED, response)
+
+    def expire(self, now=None):
+        """Remove all services which did not renew their announcement."""
+        now = time.monotonic() if now is None else now
+        for usn in [usn for usn, expires in self._expires.items()
+                    if expires <= now]:
+            self.remove(usn)
+
+    def _notify(self, event, response):
+        for callback in list(self._subscribers):
+            try:
+                callback(event, response)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Error in ssdp registry subscriber")
+
+
+class SSDPListener(asyncio.DatagramProtocol):
+    """Listen for ssdp announcements and keep a registry up to date."""
+
+    def __init__(self, registry=None, address=SSDP_ADDRESS,
+                 interface="0.0.0.0", expiry_interval=5):
+        """Init the listener, announcements are received on the given address."""
+        self.registry = registry or SSDPRegistry()
+        self.address = address
+        self.interface = interface
+        self.expiry_interval = expiry_interval
+        self._transport = None
+        self._expiry_task = None
+
+    async def start(self):
+        """Join the multicast group and start processing announcements."""
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, sock=self._create_socket())
+        self._expiry_task = loop.create_task(self._expire_services())
+
+    def stop(self):
+        """Stop processing announcements."""
+        if self._expiry_task:
+            self._expiry_task.cancel()
+            self._expiry_task = None
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+    @property
+    def sockname(self):
+        """Return the address the listener is bound to."""
+        return self._transport.get_extra_info("sockname")
+
+    def _create_socket(self):
+        sock = socket.socket(
+            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        RECEIVE_BUFFER_SIZE)
+
+        host, port = self.address
+        if ipaddress.ip_address(host).is_multicast:
+            sock.bind(("", port))
+            membership = struct.pack("4s4s", socket.inet_aton(host),
+                                     socket.inet_aton(self.interface))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            membership)
+        else:
+            sock.bind(self.address)
+        sock.setblocking(False)
+        return sock
+
+    def datagram_received(self, data, addr):
+        """Apply a received announcement to the registry."""
+        nts, response = _parse_notify(data)
+        if nts == NTS_ALIVE:
+            self.registry.update(response)
+        elif nts == NTS_BYEBYE:
+            self.registry.remove(response.usn)
+
+    def error_received(self, exc):
+        """Log socket errors, the listener keeps running."""
+        _LOGGER.debug("Error while listening for ssdp announcements: %s", exc)
+
+    async def _expire_services(self):
+        while True:
+            await asyncio.sleep(self.expiry_interval)
+            self.registry.expire()
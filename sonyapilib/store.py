@@ -0,0 +1,150 @@
+"""Store the configuration of many devices in a single sqlite database."""
+import logging
+import sqlite3
+import threading
+
+import jsonpickle
+
+from sonyapilib.device import SonyDevice
+
+_LOGGER = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY,
+    host TEXT NOT NULL UNIQUE,
+    mac TEXT,
+    nickname TEXT
+);
+CREATE INDEX IF NOT EXISTS devices_mac ON devices (mac);
+CREATE INDEX IF NOT EXISTS devices_nickname ON devices (nickname);
+CREATE TABLE IF NOT EXISTS fields (
+    device_id INTEGER NOT NULL REFERENCES devices (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (device_id, name)
+);
+"""
+
+
+class DeviceStore():
+    """Store many devices in one sqlite database.
+
+    Every attribute of a device is stored as separate json document,
+    saving a device only writes the attributes which changed since it
+    was loaded or saved the last time.
+    Devices can be looked up by host, mac and nickname.
+    """
+
+    def __init__(self, path):
+        """Open or create the database at the given path."""
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        # encoded attributes as they are in the database, by host
+        self._written = {}
+
+    def __enter__(self):
+        """Use the store as context manager."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the database."""
+        self.close()
+
+    def close(self):
+        """Close the database."""
+        self._connection.close()
+
+    def save(self, device):
+        """Save the device and return the names of the written attributes."""
+        fields = {name: jsonpickle.encode(value)
+                  for name, value in device.__getstate__().items()}
+
+        with self._lock, self._connection:
+            written = self._get_written(device.host)
+            changed = {name: value for name, value in fields.items()
+                       if written.get(name) != value}
+            removed = [name for name in written if name not in fields]
+            if not changed and not removed:
+                return []
+
+            self._connection.execute(
+                "INSERT INTO devices (host, mac, nickname) VALUES (?, ?, ?) "
+                "ON CONFLICT (host) DO UPDATE SET mac = excluded.mac, "
+                "nickname = excluded.nickname",
+                (device.host, device.mac, device.nickname))
+            device_id = self._device_id(device.host)
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO fields (device_id, name, value) "
+                "VALUES (?, ?, ?)",
+                [(device_id, name, value) for name, value in changed.items()])
+            self._connection.executemany(
+                "DELETE FROM fields WHERE device_id = ? AND name = ?",
+                [(device_id, name) for name in removed])
+            self._written[device.host] = fields
+
+        _LOGGER.debug("Saved %s of %s", list(changed), device.host)
+        return list(changed) + removed
+
+    def load(self, host):
+        """Load the device with the given host, None if it is not stored."""
+        devices = self._load("WHERE devices.host = ?", (host,))
+        return devices[0] if devices else None
+
+    def load_all(self):
+        """Load all stored devices."""
+        return self._load("", ())
+
+    def find(self, host=None, mac=None, nickname=None):
+        """Get the hosts of all devices matching the given values."""
+        conditions = [(column, value) for column, value
+                      in (("host", host), ("mac", mac), ("nickname", nickname))
+                      if value is not None]
+        where = " AND ".join(f"{column} = ?" for column, _ in conditions)
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT host FROM devices {'WHERE ' if where else ''}{where} "
+                "ORDER BY id", [value for _, value in conditions]).fetchall()
+        return [host for host, in rows]
+
+    def delete(self, host):
+        """Remove a device from the store."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM devices WHERE host = ?", (host,))
+            self._written.pop(host, None)
+
+    def _device_id(self, host):
+        return self._connection.execute(
+            "SELECT id FROM devices WHERE host = ?", (host,)).fetchone()[0]
+
+    def _get_written(self, host):
+        if host not in self._written:
+            rows = self._connection.execute(
+                "SELECT name, value FROM fields JOIN devices "
+                "ON devices.id = fields.device_id WHERE devices.host = ?",
+                (host,)).fetchall()
+            self._written[host] = dict(rows)
+        return self._written[host]
+
+    def _load(self, where, params):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT devices.host, fields.name, fields.value FROM fields "
+                f"JOIN devices ON devices.id = fields.device_id {where} "
+                "ORDER BY devices.id", params).fetchall()
+
+            written = {}
+            for host, name, value in rows:
+                written.setdefault(host, {})[name] = value
+            self._written.update(written)
+
+        devices = []
+        for fields in written.values():
+            # restore the same way jsonpickle restores a stored device
+            device = SonyDevice.__new__(SonyDevice)
+            device.__setstate__({name: jsonpickle.decode(value)
+                                 for name, value in fields.items()})
+            devices.append(device)
+        return devices
@@ -0,0 +1,213 @@
+"""Client for the ScalarWebAPI json-rpc interface of v4 devices."""
+import itertools
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_VERSION = "1.0"
+# requests the latest version of a method the device offers
+LATEST_VERSION = "latest"
+# items requested per page of paginated methods like getContentList
+DEFAULT_PAGE_SIZE = 50
+
+# runs the calls of WebApiClient.call_many and prefetches pages
+_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sonyapilib-webapi")
+
+# method signatures by model, interface version, firmware and service, shared
+# by all devices
+_SIGNATURES = {}
+_DISCOVERY_LOCKS = {}
+
+MethodSignature = namedtuple("MethodSignature", ["name", "params", "results", "version"])
+
+
+def _version_key(version):
+    return tuple(int(part) for part in version.split(".") if part.isdigit())
+
+
+class WebApiError(Exception):
+    """Error returned by a ScalarWebAPI method."""
+
+    def __init__(self, method, code, message=None):
+        """Init the error with the code and message of the response."""
+        super().__init__(f"{method} failed with {code}: {message}")
+        self.method = method
+        self.code = code
+        self.message = message
+
+
+class WebApiClient:
+    """JSON-RPC client for the services below the base url of a v4 device.
+
+    Requests are sent with the session, headers, timeouts and limiter of
+    the device. The method signatures of a service are discovered once per
+    model and firmware and shared by all clients.
+    """
+
+    def __init__(self, device):
+        """Init the client of the given device."""
+        self.device = device
+        self._ids = itertools.count(1)
+        self._interface = None
+        self._firmware = None
+
+    def next_id(self):
+        """Get the id of the next request."""
+        return next(self._ids)
+
+    def request(self, method, params=None, version=None):
+        """Create the json-rpc request of a method call."""
+        return {
+            "method": method,
+            "params": [] if params is None else params,
+            "id": self.next_id(),
+            "version": version or DEFAULT_VERSION
+        }
+
+    def call(self, service, method, params=None, version=None, **kwargs):
+        """Call a method of a service and return its result.
+
+        Without version 1.0 is used, with LATEST_VERSION the latest version
+        the device offers, which discovers the service. Further arguments
+        are passed to the request, e.g. the operation. Calls are not
+        retried unless an operation like status is given. Raises WebApiError
+        for errors of the method and RequestException if the device
+        cannot be reached.
+        """
+        if version == LATEST_VERSION:
+            version = self._latest_version(service, method)
+        # pylint: disable=protected-access
+        response = self.device._post_webapi(
+            service, self.request(method, params, version), raise_errors=True, **kwargs)
+        if not response:
+            raise WebApiError(method, None, "no response")
+
+        data = response.json()
+        if not data:
+            raise WebApiError(method, None, "empty response")
+        error = data.get("error")
+        if error:
+            raise WebApiError(method, *list(error)[:2])
+        # getMethodTypes answers with results instead of result
+        result = data.get("result")
+        return result if result is not None else data.get("results")
+
+    def call_many(self, calls, **kwargs):
+        """Run independent calls concurrently, the results are in the order of calls.
+
+        Each call is a (service, method, params) tuple, failed calls are
+        returned as their exception.
+        """
+        futures = [_EXECUTOR.submit(self.call, service, method, params, **kwargs)
+                   for service, method, params in calls]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except (WebApiError, requests.exceptions.RequestException) as ex:
+                results.append(ex)
+        return results
+
+    def iter_pages(self, service, method, params=None, page_size=DEFAULT_PAGE_SIZE,
+                   version=None, **kwargs):
+        # pylint: disable=too-many-arguments
+        """Yield the items of a paginated method like getContentList.
+
+        The pages are requested with stIdx and cnt added to params. The
+        next page is requested while the caller processes the current one,
+        no further pages are requested once the caller stops iterating.
+        Pages are read as status operation unless another one is given.
+        """
+        params = dict(params or {})
+        kwargs.setdefault("operation", "status")
+
+        def fetch(index):
+            result = self.call(service, method, [dict(params, stIdx=index, cnt=page_size)],
+                               version, **kwargs)
+            return result[0] if result else []
+
+        index = 0
+        future = _EXECUTOR.submit(fetch, index)
+        try:
+            while future is not None:
+                items = future.result()
+                index += len(items)
+                # a short page is the last one
+                future = _EXECUTOR.submit(fetch, index) if len(items) >= page_size else None
+                yield from items
+        finally:
+            if future is not None:
+                future.cancel()
+
+    @property
+    def interface(self):
+        """Get the interface information of the device, e.g. its interface version."""
+        if self._interface is None:
+            self._interface = self.call(
+                "system", "getInterfaceInformation", operation="description")[0]
+        return self._interface
+
+    @property
+    def firmware(self):
+        """Get the firmware version of the device, None if it is not reported."""
+        if self._firmware is None:
+            try:
+                info = self.call("system", "getSystemInformation",
+                                 operation="description")[0]
+            except (WebApiError, requests.exceptions.HTTPError) as ex:
+                # e.g. devices which require authentication
+                _LOGGER.debug("Failed to read the firmware version: %s", ex)
+                info = {}
+            self._firmware = info.get("fwVersion") or info.get("generation") or ""
+        return self._firmware or None
+
+    def signatures(self, service):
+        """Get the signatures of the methods of a service by name and version.
+
+        They are read with getVersions and getMethodTypes the first time a
+        service of a model and firmware is used.
+        """
+        key = self._key(service)
+        signatures = _SIGNATURES.get(key)
+        if signatures is None:
+            with _DISCOVERY_LOCKS.setdefault(key, threading.Lock()):
+                signatures = _SIGNATURES.get(key)
+                if signatures is None:
+                    signatures = _SIGNATURES[key] = self._discover(service)
+        return signatures
+
+    def supports(self, service, method, version=None):
+        """Check if the device offers a method, optionally in the given version."""
+        versions = self.signatures(service).get(method, {})
+        return bool(versions) if version is None else version in versions
+
+    def _key(self, service):
+        model = self.device.model_name or self.interface.get("modelName")
+        return model, self.interface.get("interfaceVersion"), self.firmware, service
+
+    def _discover(self, service):
+        _LOGGER.debug("Reading the method types of %s", service)
+        versions = self.call(service, "getVersions", operation="description")[0]
+        results = self.call_many([(service, "getMethodTypes", [version])
+                                  for version in versions], operation="description")
+        signatures = {}
+        for result in results:
+            # incomplete signatures are not cached
+            if isinstance(result, Exception):
+                raise result
+            for name, params, returns, version in result:
+                signatures.setdefault(name, {})[version] = MethodSignature(
+                    name, params, returns, version)
+        return signatures
+
+    def _latest_version(self, service, method):
+        """Get the latest version of a method, 1.0 if the device does not offer it."""
+        versions = self.signatures(service).get(method)
+        if not versions:
+            return DEFAULT_VERSION
+        return max(versions, key=_version_key)
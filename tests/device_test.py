@@ -1,6 +1,9 @@
 """Test implementation for devices"""
+import asyncio
 import os.path
 import sys
+import threading
+import time
 import unittest
 from inspect import getsourcefile
 from unittest import mock
@@ -9,7 +12,8 @@ from urllib.parse import (
 )
 
 import jsonpickle
-from requests import HTTPError, URLRequired, RequestException
+from requests import ConnectionError as RequestsConnectionError, HTTPError, URLRequired, RequestException, Session, Timeout
+from requests.cookies import RequestsCookieJar
 
 from tests.testutil import read_file
 
@@ -19,8 +23,10 @@ sys.path.insert(0, current_dir[:current_dir.rfind(os.path.sep)])
 # is necessary to load the local library.
 # otherwise it must be installed after every change
 import sonyapilib.device  # import  to change timeout
+from sonyapilib.limiter import RateLimiter
 from sonyapilib.ssdp import SSDPResponse
-from sonyapilib.device import SonyDevice, XmlApiObject, AuthenticationResult, HttpMethod
+from sonyapilib.device import SonyDevice, XmlApiObject, AuthenticationResult, HttpMethod, RetryPolicy, TimeoutPolicy
+from sonyapilib.device import CHANNEL_IRCC, CHANNEL_WEBAPI
 sys.path.pop(0)
 
 
@@ -43,6 +49,7 @@ APP_LIST_URL = 'http://test:50202/appslist'
 APP_LIST_URL_V4 = 'http://test/DIAL/sony/applist'
 APP_START_URL_LEGACY = 'http://test:50202/apps/'
 APP_START_URL = 'http://test/DIAL/apps/'
+DIAL_STATE = '<service xmlns="urn:dial-multiscreen-org:schemas:dial"><state>{}</state></service>'
 SOAP_URL = 'http://test/soap'
 GET_REMOTE_CONTROLLER_INFO_URL = "http://test/getRemoteControllerInfo"
 BASE_URL = 'http://test/sony'
@@ -97,6 +104,13 @@ def mock_discovery(*args, **kwargs):
     return None
 
 
+async def mock_discovery_async(*args, **kwargs):
+    for location in [IRCC_URL, DMR_URL, "http://test2:52323/dmr.xml"]:
+        resp = SSDPResponse(None)
+        resp.location = location
+        yield resp
+
+
 class MockResponseJson:
     def __init__(self, data):
         self.data = data
@@ -259,13 +273,99 @@ class SonyDeviceTest(unittest.TestCase):
         self.assertEqual(mock_update_service_url.call_count, 1)
         self.assertEqual(mock_recreate_auth.call_count, 1)
         self.assertEqual(mock_update_command.call_count, 1)
-        self.assertEqual(mock_update_applist.call_count, 1)
+        # the app list is loaded on first use
+        self.assertEqual(mock_update_applist.call_count, 0)
 
     @mock.patch('sonyapilib.ssdp.SSDPDiscovery.discover', side_effect=mock_discovery)
     def test_discovery(self, mock_discover):
         devices = SonyDevice.discover()
         self.assertEqual(len(devices), 1)
         self.assertEqual(devices[0].host, "test")
+        self.assertEqual(devices[0].nickname, "sonyapilib")
+
+    @mock.patch('sonyapilib.device.SonyDevice.init_device', side_effect=mock_nothing)
+    @mock.patch('sonyapilib.ssdp.SSDPDiscovery.discover', side_effect=mock_discovery)
+    def test_discovery_init(self, mock_discover, mock_init_device):
+        devices, failures = SonyDevice.discover("nick", init=True)
+        self.assertEqual(len(devices), 1)
+        self.assertEqual(devices[0].nickname, "nick")
+        self.assertFalse(failures)
+        self.assertEqual(mock_init_device.call_count, 1)
+
+    def test_init_devices(self):
+        def init_device(device):
+            if device.host == "error":
+                raise ValueError()
+            if device.host == "slow":
+                time.sleep(0.5)
+            device.friendly_name = device.host
+
+        devices = [SonyDevice(host, "test") for host in ["a", "slow", "error", "b", "c"]]
+        with mock.patch.object(SonyDevice, 'init_device', autospec=True,
+                               side_effect=init_device):
+            start = time.monotonic()
+            initialized, failures = SonyDevice.init_devices(devices, max_workers=2, timeout=0.1)
+            self.assertLess(time.monotonic() - start, 0.4)
+
+        self.assertEqual([device.friendly_name for device in initialized], ["a", "b", "c"])
+        self.assertEqual({device.host: type(ex) for device, ex in failures.items()},
+                         {"slow": TimeoutError, "error": ValueError})
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_refresh(self, mock_get, mock_post):
+        device = self.create_device()
+        device.pin = 1234
+        device.init_device()
+        device.get_apps()
+        self.assertEqual(set(device.resource_hashes), {"dmr", "ircc", "actionlist", "commands", "apps"})
+        self.assertIn("YouTube", device.apps)
+
+        device.friendly_name = "renamed"
+        self.assertFalse(device.refresh())
+        self.assertEqual(device.friendly_name, "renamed")
+
+        app_list = read_file("data/appsList.xml")
+        start = app_list.index("<app>", app_list.index("YouTube") - 200)
+        end = app_list.index("</app>", start) + len("</app>")
+
+        def get_changed(url, **kwargs):
+            if url == APP_LIST_URL:
+                return MockResponse(None, 200, app_list[:start] + app_list[end:])
+            if url == DMR_URL:
+                return MockResponse(None, 200, read_file("data/dmr_v3.xml") + " ")
+            return mocked_requests_get(url, **kwargs)
+
+        transport_url = device.av_transport_url
+        device.av_transport_url = None
+        mock_get.side_effect = get_changed
+        diff = device.refresh()
+        self.assertEqual(diff.apps_removed, {"YouTube"})
+        self.assertEqual(diff.apps_added, set())
+        self.assertEqual(diff.commands_removed, set())
+        self.assertEqual(diff.changed, {"av_transport_url": (None, transport_url)})
+        self.assertEqual(device.friendly_name, "renamed")
+        self.assertNotIn("YouTube", device.apps)
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_refresh_old_configuration(self, mock_get, mock_post):
+        device = self.create_device()
+        # configurations stored by older versions
+        del device.resource_hashes
+        del device._refreshing
+        diff = device.refresh()
+        self.assertIn("Play", diff.commands_added)
+        self.assertIn("commands", device.resource_hashes)
+
+    @mock.patch('sonyapilib.ssdp.AsyncSSDPDiscovery.discover', side_effect=mock_discovery_async)
+    def test_discovery_async(self, mock_discover):
+        async def discover():
+            return [device async for device in SonyDevice.discover_async()]
+
+        devices = asyncio.run(discover())
+        self.assertEqual([device.host for device in devices], ["test", "test2"])
+        self.assertIn("urn:schemas-sony-com:service:ScalarWebAPI:1", mock_discover.call_args[0][0])
 
     def test_save_load_from_json(self):
         device = self.create_device()
@@ -275,6 +375,13 @@ class SonyDeviceTest(unittest.TestCase):
         self.assertEqual(jdata, jdata_restored)
         self.assertEqual(restored_device.client_id, device.client_id)
 
+    def test_save_to_json_runtime_attributes(self):
+        device = self.create_device()
+        device.session = Session()
+        restored_device = SonyDevice.load_from_json(device.save_to_json())
+        self.assertIsNone(restored_device.session)
+        self.assertIsNotNone(device.session)
+
     def test_update_service_urls_error_response(self):
         device = self.create_device()
         device._update_service_urls()
@@ -295,6 +402,19 @@ class SonyDeviceTest(unittest.TestCase):
 
         self.verify_json_load_fields(device)
 
+    def test_runtime_attributes_restored(self):
+        device = self.create_device()
+        device.timeouts["keypress"] = TimeoutPolicy(1, 1)
+        device.metrics["auth_refreshes"] += 1
+        restored = jsonpickle.decode(jsonpickle.encode(device))
+        self.assertEqual(restored.timeouts, {})
+        self.assertEqual(restored.metrics, {})
+        self.assertIsNotNone(restored._auth_lock)
+
+        old = SonyDevice.load_from_json(read_file("data/v0.5.0.json"), init=False)
+        self.assertIsNone(old.session)
+        self.assertEqual(old.channel_stats, {})
+
     @mock.patch('requests.get', side_effect=mocked_requests_get)
     @mock.patch('sonyapilib.device.SonyDevice._parse_ircc', side_effect=mock_error)
     def test_update_service_urls_error_processing(self, mock_error, mocked_requests_get):
@@ -535,6 +655,29 @@ class SonyDeviceTest(unittest.TestCase):
         device.actions["getRemoteCommandList"] = action
         device._update_commands()
 
+    @mock.patch('requests.post')
+    def test_refresh_commands_v4(self, mock_post):
+        def post(url, json=None, **kwargs):
+            data = dict(jsonpickle.decode(read_file('data/commandList.json')), id=json["id"])
+            return MockResponse(data, 200, jsonpickle.encode(data))
+
+        mock_post.side_effect = post
+        device = self.create_device()
+        device.pin = 1234
+        device.api_version = 4
+        action = XmlApiObject({})
+        action.url = COMMAND_LIST_V4
+        action.value = "getRemoteCommandList"
+        device.actions["getRemoteCommandList"] = action
+        device._update_commands()
+        commands = device.commands
+        self.assertIn("Power", commands)
+
+        # the unchanged list is not parsed again
+        device._refreshing = True
+        device._update_commands()
+        self.assertIs(device.commands, commands)
+
     def start_app(self, device, app_name, mock_post, mock_send_command):
         versions = [1, 2, 3, 4]
         apps = {
@@ -562,7 +705,7 @@ class SonyDeviceTest(unittest.TestCase):
 
         for version in versions:
             device.api_version = version
-            device.start_app(app_name)
+            device.start_app(app_name, home=True)
 
             self.assertEqual(mock_post.call_count, 1)
             self.assertEqual(mock_send_command.call_count, 1)
@@ -597,6 +740,199 @@ class SonyDeviceTest(unittest.TestCase):
                 self.assertTrue(app in app_list)
                 self.start_app(device, app, mock_post, mock_send_command)
             self.assertEqual(len(device.apps), len(app_list))
+        self.assertIsNone(device.apps["Video Explorer"].url)
+        self.assertEqual(device.apps["PlayStation Video"].url,
+                         "http://static.internet.sony.tv/bivl-ww/static/service/icons/service_575/x100.png")
+
+    @mock.patch('sonyapilib.device.SonyDevice._send_command', side_effect=mock_nothing)
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_load_applist(self, mock_get, mock_post, mock_send_command):
+        device = self.create_device()
+        device.get_apps()
+        self.assertEqual(mock_get.call_count, 0)
+
+        device.pin = 1234
+        self.assertIn("YouTube", device.get_apps())
+        device.get_apps()
+        self.assertEqual(mock_get.call_count, 1)
+
+        device._apps_updated -= sonyapilib.device.APP_LIST_TTL
+        device.start_app("YouTube")
+        self.assertEqual(mock_get.call_count, 2)
+
+        def get_slow(*args, **kwargs):
+            time.sleep(0.2)
+            return mocked_requests_get(*args, **kwargs)
+
+        mock_get.side_effect = get_slow
+        errors = []
+
+        def start_unknown():
+            try:
+                device.start_app("Unknown")
+            except KeyError as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=start_unknown) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 4)
+        # a single refresh for all missing apps
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(mock_send_command.call_count, 1)
+
+    @mock.patch('requests.get')
+    def test_load_applist_failed(self, mock_get):
+        device = self.create_device()
+        device.pin = 1234
+        mock_get.side_effect = RequestsConnectionError()
+        self.assertEqual(device.get_apps(), [])
+        failed = mock_get.call_count
+        self.assertEqual(device.get_apps(), [])
+        # the device was off, the list is requested again
+        self.assertEqual(mock_get.call_count, 2 * failed)
+
+        mock_get.side_effect = mocked_requests_get
+        self.assertIn("YouTube", device.get_apps())
+        device.get_apps()
+        self.assertEqual(mock_get.call_count, 2 * failed + 1)
+
+    @mock.patch('sonyapilib.device.SonyDevice._send_command', side_effect=mock_nothing)
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('requests.get')
+    def test_start_app_fast_path(self, mock_get, mock_post, mock_send_command):
+        device = self.create_device()
+        device._update_applist = mock.Mock()
+        device.apps = {name: XmlApiObject({"name": name, "id": name})
+                       for name in ["YouTube", "Netflix"]}
+        states = {"YouTube": "stopped", "Netflix": "stopped"}
+
+        def get_state(url, **kwargs):
+            name = url[len(APP_START_URL_LEGACY):]
+            return MockResponse(None, 200, DIAL_STATE.format(states[name]))
+
+        mock_get.side_effect = get_state
+        # nothing is known about the foreground
+        device.start_app("YouTube")
+        self.assertEqual(mock_send_command.call_count, 1)
+        self.assertEqual(mock_get.call_count, 0)
+
+        # the app is still in front
+        states["YouTube"] = "running"
+        device.start_app("YouTube")
+        self.assertEqual(mock_send_command.call_count, 1)
+        self.assertEqual(mock_get.call_count, 1)
+
+        # another app was started with the remote
+        states["YouTube"] = "stopped"
+        device.start_app("YouTube")
+        self.assertEqual(mock_send_command.call_count, 2)
+
+        states["YouTube"] = "running"
+        device.start_app("Netflix")
+        self.assertEqual(mock_send_command.call_count, 3)
+
+        # a stopped app might have been replaced by another one
+        states.update({"YouTube": "stopped", "Netflix": "stopped"})
+        self.assertIsNone(device.start_app("YouTube", wait=True, timeout=0.1, interval=0.01))
+        self.assertEqual(mock_send_command.call_count, 4)
+
+        states["YouTube"] = "running"
+        self.assertLess(device.start_app("YouTube", wait=True), 1)
+        self.assertEqual(device.get_app_state("YouTube"), "running")
+        self.assertIsNone(device.get_app_state("Unknown"))
+
+        mock_get.side_effect = RequestException
+        self.assertIsNone(device.get_app_state("Netflix"))
+        self.assertEqual(mock_post.call_count, 6)
+
+    @mock.patch('sonyapilib.device.SonyDevice._send_command', side_effect=mock_nothing)
+    @mock.patch('sonyapilib.device.SonyDevice._send_http')
+    def test_start_app_from_input(self, mock_send_http, mock_send_command):
+        device = self.create_device()
+        device.api_version = 4
+        device.base_url = BASE_URL
+        device.apps = {"YouTube": XmlApiObject({"name": "YouTube", "id": "YouTube"})}
+        mock_send_http.return_value = MockResponse(
+            {"result": [{"uri": "extInput:hdmi?port=1", "source": "extInput:hdmi"}]}, 200)
+        device.start_app("YouTube")
+        self.assertEqual(mock_send_command.call_count, 0)
+        self.assertEqual(mock_send_http.call_args_list[0][1]["json"]["method"],
+                         "getPlayingContentInfo")
+
+        # an app is in front
+        mock_send_http.return_value = MockResponse({"error": [7, "Illegal State"]}, 200)
+        device._foreground_app = None
+        device.start_app("YouTube")
+        self.assertEqual(mock_send_command.call_count, 1)
+
+    @staticmethod
+    def create_auth_response(value, expires):
+        cookies = RequestsCookieJar()
+        cookies.set("auth", value, path="/sony/", expires=expires)
+        return MockResponse({}, 200, cookies=cookies)
+
+    def test_recreate_auth_cookie(self):
+        device = self.create_device()
+        self.assertEqual(device.auth_expires, 1556462645)
+        cookies = device._recreate_auth_cookie()
+        self.assertIs(device._recreate_auth_cookie(), cookies)
+        self.assertEqual(cookies.get("auth"), device.cookies.get("auth"))
+
+        device.cookies = self.create_auth_response("new", time.time() + 3600).cookies
+        self.assertEqual(device._recreate_auth_cookie().get("auth"), "new")
+        self.assertEqual(device.metrics["auth_refreshes"], 0)
+
+        device.cookies = None
+        self.assertIsNone(device.auth_expires)
+        self.assertFalse(device.start_auth_refresh())
+
+    @mock.patch('requests.post')
+    def test_refresh_authentication(self, mock_post):
+        device = self.create_device()
+        self.assertFalse(device.refresh_authentication())
+        device.pin = 1234
+        self.add_register_to_device(device, 4)
+
+        # the stored cookie is expired
+        mock_post.return_value = self.create_auth_response("new", time.time() + 3600)
+        self.assertEqual(device._recreate_auth_cookie().get("auth"), "new")
+        self.assertEqual(mock_post.call_args[0][0], REGISTRATION_URL_V4)
+        self.assertEqual(device.metrics["auth_refreshes"], 1)
+        device._recreate_auth_cookie()
+        self.assertEqual(mock_post.call_count, 1)
+
+        device.cookies = self.create_auth_response("old", time.time() + 60).cookies
+        mock_post.return_value = MockResponse(None, 401)
+        self.assertEqual(device._recreate_auth_cookie().get("auth"), "old")
+        device._recreate_auth_cookie()
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(device.metrics["auth_refresh_failures"], 1)
+        self.assertEqual(device.metrics["auth_failures"], 1)
+
+    @mock.patch('requests.post')
+    def test_start_auth_refresh(self, mock_post):
+        device = self.create_device()
+        device.pin = 1234
+        self.add_register_to_device(device, 4)
+        mock_post.return_value = self.create_auth_response("new", time.time() + 3600)
+
+        self.assertTrue(device.start_auth_refresh(margin=0))
+        # the cookie is expired, the refresh is started immediately
+        # and scheduled again for the renewed cookie
+        for _ in range(100):
+            timer = device._auth_timer
+            if timer is not None and timer.interval > 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(device.metrics["auth_refreshes"], 1)
+        self.assertEqual(device.cookies.get("auth"), "new")
+        self.assertGreater(device._auth_timer.interval, 3000)
+        device.stop_auth_refresh()
+        self.assertIsNone(device._auth_timer)
 
     def test_recreate_authentication_no_auth(self):
         versions = [1, 2]
@@ -635,6 +971,188 @@ class SonyDeviceTest(unittest.TestCase):
         self.assertTrue(device.psk)
         self.assertEqual(device.headers["X-Auth-PSK"], device.psk)
 
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    def test_timeout_policies(self, mock_get):
+        device = self.create_device()
+        device.actionlist_url = ACTION_LIST_URL
+        device._probe_legacy()
+        self.assertEqual(mock_get.call_args[1]["timeout"], (1, 2))
+
+        device.timeouts["probe"] = TimeoutPolicy(0.5, 1)
+        device._probe_legacy()
+        self.assertEqual(mock_get.call_args[1]["timeout"], (0.5, 1))
+        # without a policy
+        self.assertEqual(device.get_timeout("unknown"), TimeoutPolicy(0.1, 0.1))
+
+        # all requests of an operation share its deadline
+        device.timeouts["description"] = TimeoutPolicy(3, 15, 0.05)
+        with device._operation_deadline("description"):
+            device._send_http(ACTION_LIST_URL, HttpMethod.GET, operation="status")
+            self.assertLessEqual(max(mock_get.call_args[1]["timeout"]), 0.05)
+            time.sleep(0.05)
+            with self.assertRaises(Timeout):
+                device._send_http(ACTION_LIST_URL, HttpMethod.GET, raise_errors=True)
+        self.assertEqual(mock_get.call_count, 3)
+
+        device._send_http(ACTION_LIST_URL, HttpMethod.GET, operation="status")
+        self.assertEqual(mock_get.call_args[1]["timeout"], (2, 5))
+
+    @mock.patch('requests.get')
+    def test_retry(self, mock_get):
+        device = self.create_device()
+        device.retries["status"] = RetryPolicy(2, backoff=0.01)
+        mock_get.side_effect = [RequestsConnectionError(), Timeout(), MockResponse(None, 200, "ok")]
+        response = device._send_http(ACTION_LIST_URL, HttpMethod.GET, operation="status")
+        self.assertEqual(response.text, "ok")
+        self.assertEqual(device.metrics["retries", "/actionList"], 2)
+
+        # not a transient error
+        mock_get.side_effect = [MockResponse(None, 404), MockResponse(None, 200)]
+        self.assertIsNone(device._send_http(ACTION_LIST_URL, HttpMethod.GET, operation="status"))
+        mock_get.side_effect = [MockResponse(None, 503)] * 3
+        self.assertIsNone(device._send_http(ACTION_LIST_URL, HttpMethod.GET, operation="status"))
+        self.assertEqual(mock_get.call_count, 7)
+        self.assertEqual(device.metrics["retries", "/actionList"], 4)
+
+    @mock.patch('requests.post')
+    def test_retry_keypress(self, mock_post):
+        device = self.create_device()
+        device.control_url = SOAP_URL
+        mock_post.side_effect = RequestsConnectionError()
+        device._send_req_ircc("AAAAAQAAAAEAAABgAw==")
+        self.assertEqual(mock_post.call_count, 1)
+
+        device.retries["keypress"] = RetryPolicy(1, backoff=0.01)
+        mock_post.side_effect = [RequestsConnectionError(), MockResponse(None, 200, "data")]
+        self.assertEqual(device._send_req_ircc("AAAAAQAAAAEAAABgAw=="), "data")
+        self.assertEqual(mock_post.call_count, 3)
+
+    @mock.patch('requests.get')
+    def test_hedged_read(self, mock_get):
+        device = self.create_device()
+        device.retries["status"] = RetryPolicy(hedge_after=0.05)
+        responses = iter(["slow", "fast"])
+
+        def get(url, **kwargs):
+            text = next(responses)
+            if text == "slow":
+                time.sleep(0.3)
+            return MockResponse(None, 200, text)
+
+        mock_get.side_effect = get
+        start = time.monotonic()
+        response = device._send_http(ACTION_LIST_URL, HttpMethod.GET, operation="status")
+        self.assertEqual(response.text, "fast")
+        self.assertLess(time.monotonic() - start, 0.25)
+        self.assertEqual(device.metrics["hedged", "/actionList"], 1)
+
+        # fast responses are not hedged
+        responses = iter(["fast"])
+        device._send_http(ACTION_LIST_URL, HttpMethod.GET, operation="status")
+        self.assertEqual(mock_get.call_count, 3)
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    def test_rate_limit(self, mock_post):
+        device = self.create_device()
+        device.control_url = SOAP_URL
+        device.limiter = RateLimiter(rate=20, burst=1, reserve=0)
+        for _ in range(3):
+            device._send_req_ircc("AAAAAQAAAAEAAABgAw==")
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(device.metrics["requests", "KEYPRESS"], 3)
+        self.assertGreater(device.metrics["queue_delay", "KEYPRESS"], 0.08)
+
+    @mock.patch('sonyapilib.device.SonyDevice._send_http')
+    @mock.patch('sonyapilib.device.SonyDevice._send_command')
+    def test_channel_selection(self, mock_send_command, mock_send_http):
+        device = self.create_device()
+        device.base_url = BASE_URL
+        device.api_version = 4
+
+        def slow_command(name):
+            time.sleep(0.02)
+            return "data"
+
+        mock_send_command.side_effect = slow_command
+        mock_send_http.return_value = MockResponse({"result": [0]}, 200)
+        # both channels are tried once, then the faster one is used
+        for _ in range(4):
+            device.volume_up()
+        self.assertEqual(mock_send_command.call_count, 1)
+        self.assertEqual(mock_send_http.call_count, 3)
+        self.assertEqual(mock_send_http.call_args[0][0], urljoin(BASE_URL, "audio"))
+        self.assertEqual(mock_send_http.call_args[1]["json"]["params"],
+                         [{"target": "speaker", "volume": "+1"}])
+        self.assertEqual(device.channel_stats[CHANNEL_WEBAPI].requests, 3)
+
+        # keypresses are not sent twice, failing channels are avoided
+        mock_send_http.return_value = MockResponse({"error": [403, "Forbidden"]}, 200)
+        for _ in range(6):
+            device.volume_down()
+        self.assertEqual(mock_send_http.call_count, 7)
+        self.assertEqual(mock_send_command.call_count, 3)
+        self.assertEqual(mock_send_command.call_args[0][0], "VolumeDown")
+        self.assertLess(device.channel_stats[CHANNEL_WEBAPI].success_rate, 0.5)
+
+        # turning the device off is idempotent and falls back
+        mock_send_command.side_effect = None
+        mock_send_command.return_value = False
+        device.power(False)
+        self.assertEqual(mock_send_command.call_count, 4)
+        self.assertEqual(mock_send_http.call_count, 8)
+        self.assertEqual(mock_send_http.call_args[1]["json"]["method"], "setPowerStatus")
+
+        device.channel = CHANNEL_WEBAPI
+        device.power(False)
+        self.assertEqual(mock_send_http.call_count, 9)
+        self.assertEqual(mock_send_command.call_count, 4)
+
+    @mock.patch('sonyapilib.device.SonyDevice._send_http')
+    @mock.patch('sonyapilib.device.SonyDevice._send_command', return_value="data")
+    def test_channel_no_exploration(self, mock_send_command, mock_send_http):
+        device = self.create_device()
+        device.base_url = BASE_URL
+        device.api_version = 4
+        mock_send_http.return_value = MockResponse({"error": [403, "Forbidden"]}, 200)
+        # only the first try of the failing channel drops a keypress
+        for _ in range(40):
+            device.volume_up()
+        self.assertEqual(mock_send_http.call_count, 1)
+        self.assertEqual(mock_send_command.call_count, 39)
+
+    @mock.patch('sonyapilib.device.SonyDevice._send_command', side_effect=ValueError)
+    def test_channel_legacy(self, mock_send_command):
+        device = self.create_device()
+        # only ircc is available, its errors are passed on
+        with self.assertRaises(ValueError):
+            device.volume_up()
+        self.assertEqual(list(device.channel_stats), [CHANNEL_IRCC])
+
+    def test_request_headers(self):
+        device = self.create_device()
+        headers = device._request_headers()
+        self.assertIs(device._request_headers(), headers)
+        with self.assertRaises(TypeError):
+            headers["Authorization"] = "foo"
+
+        device.pin = 1234
+        self.add_register_to_device(device, 4)
+        device._recreate_authentication()
+        authenticated = device._request_headers()
+        self.assertEqual(authenticated["Authorization"], "Basic OjEyMzQ=")
+        self.assertNotIn("Authorization", headers)
+
+        # headers are only replaced if the auth state changed
+        device._recreate_authentication()
+        self.assertIs(device._request_headers(), authenticated)
+        device.pin = 5678
+        device._recreate_authentication()
+        self.assertEqual(device._request_headers()["Authorization"], "Basic OjU2Nzg=")
+
+        # e.g. restored from json
+        device.headers = {"foo": "bar"}
+        self.assertEqual(dict(device._request_headers()), {"foo": "bar"})
+
     @mock.patch('requests.get', side_effect=mocked_requests_get)
     def test_register_no_auth(self, mocked_get):
         versions = [1, 2]
@@ -895,6 +1413,86 @@ class SonyDeviceTest(unittest.TestCase):
         self.assertEqual(mock_wake_on_lan.call_count, 1)
         self.assertEqual(mock_send_command.mock_calls[0][1][0], "Power")
 
+    @mock.patch('sonyapilib.device.SonyDevice._send_command', side_effect=mock_nothing)
+    @mock.patch('sonyapilib.device.SonyDevice.wakeonlan', side_effect=mock_nothing)
+    def test_power_on_ready(self, mock_wake_on_lan, mock_send_command):
+        device = self.create_device()
+        self.create_command_list(device)
+        states = [None, None, "active"]
+        with mock.patch.object(SonyDevice, '_probe_power_status', side_effect=states) as mock_probe:
+            time_to_ready = device.power_on(deadline=5, probe_delay=0.01)
+        self.assertIsNotNone(time_to_ready)
+        self.assertLess(time_to_ready, 1)
+        self.assertEqual(mock_probe.call_count, 3)
+        self.assertEqual(mock_wake_on_lan.call_count, 3)
+        self.assertEqual(mock_send_command.call_count, 0)
+
+    @mock.patch('sonyapilib.device.SonyDevice._send_command', side_effect=mock_nothing)
+    @mock.patch('sonyapilib.device.SonyDevice.wakeonlan', side_effect=mock_nothing)
+    def test_power_on_standby(self, mock_wake_on_lan, mock_send_command):
+        device = self.create_device()
+        device.api_version = 4
+        self.create_command_list(device)
+        states = ["standby", "standby", "active"]
+        with mock.patch.object(SonyDevice, '_get_power_status_v4', side_effect=states):
+            self.assertIsNotNone(device.power_on(wol_packets=1, probe_delay=0.01))
+        self.assertEqual(mock_send_command.call_count, 1)
+        self.assertEqual(mock_send_command.mock_calls[0][1][0], "Power")
+
+    @mock.patch('sonyapilib.device.SonyDevice.init_device', side_effect=mock_nothing)
+    @mock.patch('sonyapilib.device.SonyDevice.wakeonlan', side_effect=mock_nothing)
+    def test_power_on_deadline(self, mock_wake_on_lan, mock_init_device):
+        device = self.create_device()
+        # device is reachable but the command list cannot be read
+        with mock.patch.object(SonyDevice, '_probe_legacy', return_value=True) as mock_probe:
+            start = time.monotonic()
+            self.assertIsNone(device.power_on(deadline=0.2, probe_delay=0.05, max_probe_delay=0.1))
+            self.assertLess(time.monotonic() - start, 0.5)
+        self.assertGreater(mock_probe.call_count, 2)
+        self.assertEqual(mock_init_device.call_count, mock_probe.call_count)
+
+    @mock.patch('requests.get')
+    @mock.patch('sonyapilib.device.SonyDevice.wakeonlan', side_effect=mock_nothing)
+    def test_power_on_slow_init(self, mock_wake_on_lan, mock_get):
+        device = SonyDevice("test", "test")
+
+        def get_slow(*args, **kwargs):
+            time.sleep(0.1)
+            return mocked_requests_get(*args, **kwargs)
+
+        mock_get.side_effect = get_slow
+        # the deadline also bounds reading the device description
+        with mock.patch.object(SonyDevice, '_probe_power_status', return_value="active"):
+            start = time.monotonic()
+            self.assertIsNone(device.power_on(deadline=0.2, probe_delay=0.01))
+            self.assertLess(time.monotonic() - start, 0.5)
+        self.assertIsNone(device._local.deadline)
+
+    @mock.patch('requests.get')
+    @mock.patch('sonyapilib.device.SonyDevice.wakeonlan', side_effect=mock_nothing)
+    def test_power_on_uninitialized(self, mock_wake_on_lan, mock_get):
+        device = SonyDevice("test", "test")
+        responses = [RequestsConnectionError(), RequestsConnectionError(),
+                     MockResponse(None, 200, "dmr")]
+        mock_get.side_effect = responses
+
+        def init_device():
+            self.create_command_list(device)
+
+        with mock.patch.object(SonyDevice, 'init_device', side_effect=init_device):
+            self.assertIsNotNone(device.power_on(deadline=5, probe_delay=0.01))
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(mock_get.call_args[0][0], DMR_URL)
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    def test_probe_power_status_v4(self, mocked_post):
+        device = self.create_device()
+        device.api_version = 4
+        device.base_url = REQUESTS_ERROR
+        self.assertIsNone(device._probe_power_status())
+        device.base_url = BASE_URL
+        self.assertEqual(device._probe_power_status(), "on")
+
     @mock.patch('wakeonlan.send_magic_packet', side_effect=mock_nothing())
     def test_wake_on_lan(self, mocked_wol):
         device = self.create_device()
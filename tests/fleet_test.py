@@ -0,0 +1,356 @@
+"""Test for controlling many devices"""
+import os.path
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from inspect import getsourcefile
+from unittest import mock
+
+current_dir = os.path.dirname(os.path.abspath(getsourcefile(lambda: 0)))
+sys.path.insert(0, current_dir[:current_dir.rfind(os.path.sep)])
+# cannot be imported at a different position because path modification
+# is necessary to load the local library.
+# otherwise it must be installed after every change
+from sonyapilib.device import RetryPolicy, SonyDevice, TimeoutPolicy
+from sonyapilib.fleet import (
+    MAX_POOLED_HOSTS,
+    DeviceState,
+    PollingScheduler,
+    SonyDeviceFleet,
+    WakeOnLan,
+    load_devices,
+)
+sys.path.pop(0)
+
+from tests.testutil import read_file
+
+
+def create_device(host, mac=None, broadcast_address="255.255.255.255"):
+    """Create a device with the given network data"""
+    device = SonyDevice(host, "test", broadcast_address=broadcast_address)
+    device.mac = mac
+    return device
+
+
+class LoadDevicesTest(unittest.TestCase):
+
+    @mock.patch('sonyapilib.device.SonyDevice.init_device')
+    def test_load_blobs(self, mock_init_device):
+        blobs = [read_file("data/v0.5.0.json"), "invalid", read_file("data/v0.6.0.json")]
+        devices, failures = load_devices(blobs)
+        self.assertEqual(len(devices), 2)
+        self.assertEqual(list(failures), [1])
+        self.assertEqual(devices[0].host, "test")
+        self.assertEqual(mock_init_device.call_count, 0)
+
+    @mock.patch('sonyapilib.device.SonyDevice.init_device')
+    def test_load_directory(self, mock_init_device):
+        with tempfile.TemporaryDirectory() as directory:
+            for index in range(3):
+                with open(os.path.join(directory, f"{index}.json"), "w") as config:
+                    config.write(SonyDevice(f"host{index}", "test").save_to_json())
+            with open(os.path.join(directory, "ignored.txt"), "w") as config:
+                config.write("foo")
+            devices, failures = load_devices(directory)
+
+        self.assertEqual([device.host for device in devices], ["host0", "host1", "host2"])
+        self.assertFalse(failures)
+
+    def test_fleet_load(self):
+        blobs = [SonyDevice(f"host{index}", "test").save_to_json() for index in range(3)]
+        progress = []
+        finished = threading.Event()
+
+        def report(count, total, device, error):
+            progress.append((count, total, device.host, error))
+            if count == total:
+                finished.set()
+
+        def init_device(device):
+            if device.host == "host1":
+                raise ValueError()
+
+        with SonyDeviceFleet() as fleet, \
+                mock.patch.object(SonyDevice, 'init_device', autospec=True, side_effect=init_device):
+            devices, _ = fleet.load(blobs, progress=report)
+            self.assertEqual(len(devices), 3)
+            self.assertEqual(list(fleet.devices), ["host0", "host1", "host2"])
+            self.assertTrue(finished.wait(1))
+
+        self.assertEqual(sorted(count for count, _, _, _ in progress), [1, 2, 3])
+        errors = {host: type(error) for _, _, host, error in progress if error}
+        self.assertEqual(errors, {"host1": ValueError})
+
+    @mock.patch('sonyapilib.device.SonyDevice.init_device')
+    def test_fleet_load_no_refresh(self, mock_init_device):
+        with SonyDeviceFleet() as fleet:
+            fleet.load([read_file("data/v0.6.0.json")], refresh=False)
+            self.assertIs(fleet.devices["test"].session, fleet.session)
+        self.assertEqual(mock_init_device.call_count, 0)
+
+
+class WakeOnLanTest(unittest.TestCase):
+
+    @mock.patch('socket.socket')
+    def test_send(self, mock_socket):
+        sock = mock_socket.return_value.__enter__.return_value
+        devices = [
+            create_device("a", "30-52-cb-cc-16-ee"),
+            create_device("b", "10:08:B1:31:81:B5"),
+            create_device("c", "10:08:B1:31:81:B6", "10.0.1.255"),
+            create_device("d"),
+            create_device("e", "invalid"),
+        ]
+        wol = WakeOnLan(devices)
+        missing = wol.send(repeats=2, interval=0)
+
+        self.assertEqual([device.host for device in missing], ["d", "e"])
+        # one socket per broadcast domain
+        self.assertEqual(mock_socket.call_count, 2)
+        self.assertEqual(sock.sendto.call_count, 6)
+        packet, address = sock.sendto.call_args_list[0][0]
+        self.assertEqual(packet, bytes.fromhex("F" * 12 + "3052cbcc16ee" * 16))
+        self.assertEqual(address, ("255.255.255.255", 9))
+        self.assertEqual(sock.sendto.call_args_list[-1][0][1], ("10.0.1.255", 9))
+
+    @mock.patch('socket.socket')
+    def test_send_error(self, mock_socket):
+        sock = mock_socket.return_value.__enter__.return_value
+        sock.sendto.side_effect = OSError()
+        wol = WakeOnLan([create_device("a", "30-52-cb-cc-16-ee"),
+                         create_device("b", "10:08:B1:31:81:B5", "10.0.1.255")])
+        self.assertEqual(wol.send(), [])
+        self.assertEqual(sock.sendto.call_count, 2)
+
+
+class SonyDeviceFleetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.devices = [create_device(host) for host in ["a", "b", "c"]]
+        self.fleet = SonyDeviceFleet(self.devices, max_workers=4)
+
+    def tearDown(self):
+        self.fleet.close()
+
+    def test_shared_session(self):
+        for device in self.devices:
+            self.assertIs(device.session, self.fleet.session)
+        device = self.fleet.remove("a")
+        self.assertIsNone(device.session)
+        self.assertEqual(list(self.fleet.devices), ["b", "c"])
+
+    def test_connection_pool(self):
+        adapter = self.fleet.session.get_adapter("http://a")
+        self.assertEqual(adapter._pool_connections, MAX_POOLED_HOSTS)
+        self.assertEqual(adapter._pool_maxsize, 1)
+
+    def test_hedge_executor(self):
+        executor = self.devices[0].hedge_executor
+        self.assertIs(self.devices[1].hedge_executor, executor)
+        # room for the hedged reads of all workers
+        self.assertEqual(executor._max_workers, 8)
+        device = self.fleet.remove("a")
+        self.assertIsNot(device.hedge_executor, executor)
+
+    @mock.patch('requests.Session.get')
+    def test_requests_use_session(self, mock_get):
+        self.devices[0].get_power_status()
+        self.assertEqual(mock_get.call_count, 1)
+
+    @mock.patch('requests.Session.get')
+    def test_timeouts(self, mock_get):
+        device = create_device("d")
+        with SonyDeviceFleet([device], timeouts={"probe": TimeoutPolicy(0.2, 0.3)},
+                             retries={"keypress": RetryPolicy(2)}):
+            device.get_power_status()
+        self.assertEqual(mock_get.call_args[1]["timeout"], (0.2, 0.3))
+        self.assertEqual(device.get_retry_policy("keypress").retries, 2)
+        self.assertIsNone(device.limiter)
+
+        # the policies of the device win
+        device.timeouts["keypress"] = TimeoutPolicy(9, 9)
+        device.retries["status"] = RetryPolicy(0)
+        with SonyDeviceFleet([device], timeouts={"keypress": TimeoutPolicy(1, 1)},
+                             retries={"status": RetryPolicy(3)}):
+            self.assertEqual(device.get_timeout("keypress"), TimeoutPolicy(9, 9))
+            self.assertEqual(device.get_retry_policy("status").retries, 0)
+
+        with SonyDeviceFleet([device], rate_limit=3):
+            self.assertEqual(device.limiter.rate, 3)
+
+    def test_send_all(self):
+        def send_command(device, name):
+            if device.host == "b":
+                raise ValueError(f"Unknown command: {name}")
+            return name
+
+        with mock.patch.object(SonyDevice, 'send_command', autospec=True,
+                               side_effect=send_command):
+            results = {result.device.host: result for result in self.fleet.send_all("Home")}
+
+        self.assertEqual(results["a"].result, "Home")
+        self.assertIsNone(results["a"].error)
+        self.assertIsInstance(results["b"].error, ValueError)
+
+    def test_results_as_completed(self):
+        def get_power_status(device):
+            time.sleep(0.2 if device.host == "a" else 0)
+            return device.host != "c"
+
+        with mock.patch.object(SonyDevice, 'get_power_status', autospec=True,
+                               side_effect=get_power_status):
+            results = list(self.fleet.status_all())
+        self.assertEqual(results[-1].device.host, "a")
+        self.assertEqual({result.device.host: result.result for result in results},
+                         {"a": True, "b": True, "c": False})
+
+    def test_timeout(self):
+        with mock.patch.object(SonyDevice, 'init_device', autospec=True,
+                               side_effect=lambda device: time.sleep(0.5)):
+            start = time.monotonic()
+            results = list(self.fleet.init_all(timeout=0.1))
+            self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertIsInstance(result.error, TimeoutError)
+
+    def test_per_device_limit(self):
+        running = []
+        lock = threading.Lock()
+        concurrent = []
+
+        def function(device):
+            with lock:
+                running.append(device.host)
+                concurrent.append(running.count(device.host))
+            time.sleep(0.05)
+            with lock:
+                running.remove(device.host)
+
+        for result in self.fleet.run_all(function, hosts=["a", "a", "a", "b"]):
+            self.assertIsNone(result.error)
+        self.assertEqual(len(concurrent), 4)
+        self.assertEqual(max(concurrent), 1)
+
+
+class PollingSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.devices = [create_device(host) for host in ["a", "b"]]
+        self.fleet = SonyDeviceFleet(self.devices)
+        self.scheduler = PollingScheduler(self.fleet, jitter=0)
+        self.power = {"a": True, "b": False}
+        self.playing = {"a": "PLAYING", "b": "OFF"}
+        self.patches = [
+            mock.patch.object(SonyDevice, 'get_power_status', autospec=True,
+                              side_effect=lambda device: self.power[device.host]),
+            mock.patch.object(SonyDevice, 'get_playing_status', autospec=True,
+                              side_effect=lambda device: self.playing[device.host]),
+        ]
+        self.mocks = [patch.start() for patch in self.patches]
+
+    def tearDown(self):
+        self.scheduler.stop()
+        for patch in self.patches:
+            patch.stop()
+        self.fleet.close()
+
+    def test_interval(self):
+        self.assertEqual(self.scheduler.interval("a"), 60)
+        self.assertEqual(self.scheduler.poll("a"), DeviceState(True, "PLAYING"))
+        self.assertEqual(self.scheduler.interval("a"), 5)
+        self.playing["a"] = "STOPPED"
+        self.scheduler.poll("a")
+        # state changed recently
+        self.assertEqual(self.scheduler.interval("a"), 2)
+        self.assertEqual(self.scheduler.interval("a", time.monotonic() + 31), 15)
+
+        self.assertEqual(self.scheduler.poll("b"), DeviceState(False, "OFF"))
+        self.assertEqual(self.scheduler.interval("b"), 60)
+        # the playing status is not requested from devices which are off
+        self.assertEqual(self.mocks[1].call_count, 2)
+
+    def test_state_changes(self):
+        changes = []
+        self.scheduler.subscribe(lambda device, old, new: changes.append((device.host, old, new)))
+        self.scheduler.poll("b")
+        self.scheduler.poll("b")
+        self.assertEqual(changes, [])
+        self.power["b"] = True
+        self.playing["b"] = "STOPPED"
+        self.scheduler.poll("b")
+        self.assertEqual(changes, [("b", DeviceState(False, "OFF"), DeviceState(True, "STOPPED"))])
+
+    def test_poll_error(self):
+        self.scheduler.poll("a")
+        self.mocks[0].side_effect = ValueError()
+        self.assertEqual(self.scheduler.poll("a"), DeviceState(True, "PLAYING"))
+        self.assertIsNone(self.scheduler.poll("unknown"))
+
+    def test_rate_budget(self):
+        self.scheduler.max_rate = 2
+        self.scheduler._tokens = 2
+        now = self.scheduler._refilled
+        self.assertTrue(self.scheduler._take_token(now))
+        self.assertTrue(self.scheduler._take_token(now))
+        self.assertFalse(self.scheduler._take_token(now))
+        self.assertTrue(self.scheduler._take_token(now + 0.5))
+
+    def test_request_budget(self):
+        def get_power_status(device):
+            # e.g. a request which was retried
+            device.metrics["http_requests"] += 2
+            return self.power[device.host]
+
+        def get_playing_status(device):
+            device.metrics["http_requests"] += 1
+            return self.playing[device.host]
+
+        self.mocks[0].side_effect = get_power_status
+        self.mocks[1].side_effect = get_playing_status
+        self.scheduler._tokens = 4
+        now = self.scheduler._refilled
+        self.assertTrue(self.scheduler._take_token(now))
+        self.scheduler.poll("a")
+        # three requests were sent for one token
+        self.assertEqual(self.scheduler._tokens, 1)
+        self.assertTrue(self.scheduler._take_token(now))
+        self.scheduler.poll("b")
+        self.assertEqual(self.scheduler._tokens, -1)
+        self.assertFalse(self.scheduler._take_token(now + 0.1))
+
+    def test_start(self):
+        self.scheduler.intervals["on"] = 0.1
+        self.scheduler.start()
+        for _ in range(100):
+            if len(self.scheduler.states) == 2:
+                break
+            time.sleep(0.01)
+        self.scheduler.stop()
+        self.assertEqual(self.scheduler.states["a"], DeviceState(True, "PLAYING"))
+        self.assertEqual(self.scheduler.states["b"], DeviceState(False, "OFF"))
+
+    def test_remove_while_running(self):
+        self.scheduler.intervals.update({"on": 0.1, "off": 0.05, "playing": 0.05})
+        self.scheduler.start()
+        self.scheduler.schedule("b", 0.1)
+        self.fleet.remove("b")
+        polls = self.mocks[0].call_count
+        for _ in range(300):
+            if self.mocks[0].call_count > polls + 2:
+                break
+            time.sleep(0.01)
+        # device a is still polled
+        self.assertTrue(self.scheduler._thread.is_alive())
+        self.assertGreater(self.mocks[0].call_count, polls + 2)
+
+        self.fleet.close()
+        self.scheduler.schedule("a")
+        self.scheduler._thread.join(2)
+        self.assertFalse(self.scheduler._thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""Test the icon cache"""
+import os.path
+import sys
+import tempfile
+import unittest
+from inspect import getsourcefile
+from unittest import mock
+
+from requests import RequestException
+
+current_dir = os.path.dirname(os.path.abspath(getsourcefile(lambda: 0)))
+sys.path.insert(0, current_dir[:current_dir.rfind(os.path.sep)])
+# cannot be imported at a different position because path modification
+# is necessary to load the local library.
+# otherwise it must be installed after every change
+from sonyapilib.device import SonyDevice, XmlApiObject
+from sonyapilib.icons import IconCache
+sys.path.pop(0)
+
+ICON_URL = "http://test:52323/bdp_ax_device_icon_large.jpg"
+APP_ICON_URL = "http://static.internet.sony.tv/bivl-ww/static/service/icons/service_575/x100.png"
+
+
+class MockResponse:
+    def __init__(self, content, status_code=200, etag=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {"ETag": etag} if etag else {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RequestException()
+
+
+def create_device(host="test", model_name="BDP-S5500"):
+    device = SonyDevice(host, "test")
+    device.model_name = model_name
+    device.icons = [f"http://{host}:52323/bdp_ax_device_icon_large.jpg"]
+    device.apps["YouTube"] = XmlApiObject({"name": "YouTube", "id": "youtube", "url": APP_ICON_URL})
+    return device
+
+
+class IconCacheTest(unittest.TestCase):
+
+    @mock.patch('requests.get', return_value=MockResponse(b"icon"))
+    def test_get_icon(self, mock_get):
+        cache = IconCache()
+        device = create_device()
+        self.assertEqual(device.get_icon(cache=cache), b"icon")
+        self.assertEqual(device.get_icon(cache=cache), b"icon")
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(mock_get.call_args[0][0], ICON_URL)
+
+        # devices of the same model share icons
+        self.assertEqual(create_device("other").get_icon(cache=cache), b"icon")
+        self.assertEqual(mock_get.call_count, 1)
+        create_device("unknown", model_name=None).get_icon(cache=cache)
+        create_device("another", model_name="KD-55XF9005").get_icon(cache=cache)
+        self.assertEqual(mock_get.call_count, 3)
+
+        self.assertEqual(device.get_app_icon("YouTube", cache=cache), b"icon")
+        self.assertEqual(mock_get.call_args[0][0], APP_ICON_URL)
+        self.assertIsNone(device.get_app_icon("Netflix", cache=cache))
+        self.assertIsNone(device.get_icon(index=1, cache=cache))
+        self.assertEqual(len(cache), 4)
+
+    def test_session(self):
+        device = create_device()
+        device.session = mock.Mock()
+        device.session.get.return_value = MockResponse(b"icon")
+        self.assertEqual(device.get_icon(cache=IconCache()), b"icon")
+        self.assertEqual(device.session.get.call_count, 1)
+
+    @mock.patch('requests.get')
+    def test_revalidate(self, mock_get):
+        cache = IconCache()
+        device = create_device()
+        mock_get.return_value = MockResponse(b"icon", etag='"1"')
+        device.get_icon(cache=cache)
+
+        mock_get.return_value = MockResponse(b"", status_code=304)
+        self.assertEqual(device.get_icon(cache=cache, revalidate=True), b"icon")
+        self.assertEqual(mock_get.call_args[1]["headers"]["If-None-Match"], '"1"')
+        self.assertEqual(mock_get.call_args[1]["headers"]["X-CERS-DEVICE-ID"], "test")
+
+        mock_get.return_value = MockResponse(b"new icon", etag='"2"')
+        self.assertEqual(device.get_icon(cache=cache, revalidate=True), b"new icon")
+        self.assertEqual(cache.size, len(b"new icon"))
+
+        mock_get.side_effect = RequestException
+        self.assertEqual(device.get_icon(cache=cache, revalidate=True), b"new icon")
+        self.assertIsNone(device.get_app_icon("YouTube", cache=cache))
+
+    @mock.patch('requests.get')
+    def test_eviction(self, mock_get):
+        cache = IconCache(max_bytes=10)
+        mock_get.side_effect = lambda url, **kwargs: MockResponse(url[-4:].encode())
+        devices = [create_device(f"host{index}", model_name=None) for index in range(4)]
+        for device in devices[:2]:
+            device.get_icon(cache=cache)
+        # the first icon is used again and is kept
+        devices[0].get_icon(cache=cache)
+        devices[2].get_icon(cache=cache)
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(mock_get.call_count, 3)
+
+        devices[1].get_icon(cache=cache)
+        self.assertEqual(mock_get.call_count, 4)
+        devices[0].get_icon(cache=cache)
+        self.assertEqual(mock_get.call_count, 5)
+
+        # too large to be cached
+        mock_get.side_effect = None
+        mock_get.return_value = MockResponse(b"a large icon")
+        devices[3].get_icon(cache=cache)
+        self.assertLessEqual(cache.size, 10)
+
+    @mock.patch('requests.get', return_value=MockResponse(b"icon", etag='"1"'))
+    def test_disk(self, mock_get):
+        with tempfile.TemporaryDirectory() as directory:
+            device = create_device()
+            IconCache(directory=directory).get(device, ICON_URL)
+
+            cache = IconCache(directory=directory)
+            self.assertEqual(cache.get(device, ICON_URL), b"icon")
+            self.assertEqual(mock_get.call_count, 1)
+            self.assertEqual(len(cache), 1)
+
+            cache.clear()
+            self.assertEqual(cache.get(device, ICON_URL), b"icon")
+            self.assertEqual(mock_get.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Test the rate limiter"""
+import os.path
+import sys
+import threading
+import time
+import unittest
+from inspect import getsourcefile
+
+current_dir = os.path.dirname(os.path.abspath(getsourcefile(lambda: 0)))
+sys.path.insert(0, current_dir[:current_dir.rfind(os.path.sep)])
+# cannot be imported at a different position because path modification
+# is necessary to load the local library.
+# otherwise it must be installed after every change
+from sonyapilib.limiter import Priority, RateLimiter
+sys.path.pop(0)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_rate(self):
+        limiter = RateLimiter(rate=20, burst=2, reserve=0)
+        self.assertLess(limiter.acquire(), 0.01)
+        self.assertLess(limiter.acquire(), 0.01)
+        self.assertGreater(limiter.acquire(), 0.03)
+
+    def test_priority(self):
+        limiter = RateLimiter(rate=10, burst=1, reserve=0)
+        limiter.acquire()
+        order = []
+
+        def acquire(priority):
+            limiter.acquire(priority)
+            order.append(priority)
+
+        threads = []
+        for priority in [Priority.BACKGROUND, Priority.POLLING, Priority.KEYPRESS]:
+            thread = threading.Thread(target=acquire, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [Priority.KEYPRESS, Priority.POLLING, Priority.BACKGROUND])
+
+    def test_reserve(self):
+        limiter = RateLimiter(rate=1, burst=2, reserve=1)
+        self.assertLess(limiter.acquire(Priority.POLLING), 0.01)
+        # the last token is kept for keypresses
+        self.assertLess(limiter.acquire(Priority.KEYPRESS), 0.01)
+        self.assertEqual(RateLimiter(rate=1, burst=1, reserve=1).reserve, 0)
+
+    def test_fractional_rate(self):
+        limiter = RateLimiter(rate=0.5)
+        self.assertEqual(limiter.burst, 1)
+        self.assertEqual(limiter.reserve, 0)
+        self.assertLess(limiter.acquire(Priority.KEYPRESS), 0.01)
+        limiter = RateLimiter(rate=5, burst=0.5, reserve=2)
+        self.assertEqual((limiter.burst, limiter.reserve), (1, 0))
+        self.assertLess(limiter.acquire(Priority.POLLING), 0.01)
+        self.assertGreater(limiter.acquire(Priority.POLLING), 0.15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,42 +1,85 @@
 """Test for simple service discovery protocol"""
+import asyncio
 import os.path as path
+import re
+import socket
 import sys
+import threading
+import time
 import unittest
 from inspect import getsourcefile
 from socket import timeout
 from unittest import mock
 
-from tests.testutil import read_file_bin
+from tests.testutil import read_file
 
 current_dir = path.dirname(path.abspath(getsourcefile(lambda: 0)))
 sys.path.insert(0, current_dir[:current_dir.rfind(path.sep)])
 # cannot be imported at a different position because path modification
 # is necessary to load the local library.
 # otherwise it must be installed after every change
-from sonyapilib.ssdp import SSDPDiscovery
+from sonyapilib.ssdp import (
+    AsyncSSDPDiscovery,
+    SSDPDiscovery,
+    SSDPDiscoveryCache,
+    SSDPEvent,
+    SSDPListener,
+    SSDPRegistry,
+    SSDPResponse,
+    _parse_notify,
+    _parse_response,
+)
 
 sys.path.pop(0)
 
 
+def read_datagrams():
+    """Split the recorded ssdp traffic into single datagrams."""
+    data = read_file("data/ssdp.txt")
+    return [part.encode() for part in re.split(r"(?m)^(?=HTTP/1\.1 200 OK)", data)
+            if part.strip()]
+
+
+def create_notify(nts, usn="uuid:test::urn:schemas-sony-com:service:IRCC:1",
+                  location="http://10.0.0.102:52323/dmr.xml", max_age=1800):
+    """Create an announcement datagram"""
+    lines = ["NOTIFY * HTTP/1.1", "HOST: 239.255.255.250:1900",
+             "NT: urn:schemas-sony-com:service:IRCC:1",
+             f"NTS: {nts}", f"USN: {usn}"]
+    if nts == "ssdp:alive":
+        lines += [f"LOCATION: {location}", f"CACHE-CONTROL: max-age={max_age}"]
+    return "\r\n".join(lines + ["", ""]).encode()
+
+
 def mock_socket(*args, **kwargs):
     """Mock class for request socket"""
     class MockSocket:
         def __init__(self):
-            self.offset = 0
+            self.datagrams = read_datagrams()
+            self.timeout = None
+            self.sent = 0
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
 
         def setsockopt(self, *args):
             pass
 
+        def settimeout(self, value):
+            self.timeout = value
+
         def sendto(self, *args):
-            pass
+            self.sent += 1
 
-        def recv(self, size):
-            data = read_file_bin("data/ssdp.txt", size=size, offset=self.offset)
-            if not data:
+        def recvfrom(self, size):
+            if not self.datagrams:
+                time.sleep(self.timeout)
                 raise timeout()
 
-            self.offset = self.offset + len(data)
-            return data
+            return self.datagrams.pop(0)[:size], ("10.0.0.1", 1900)
 
     return MockSocket()
 
@@ -49,7 +92,9 @@ class SSDPDiscoveryTest(unittest.TestCase):
         """Test discovery of ssdp services"""
         discovery = SSDPDiscovery()
         services = discovery.discover()
-        self.assertEqual(len(services), 9)
+        # services are unique by usn
+        self.assertEqual(len(services), 40)
+        self.assertEqual(len({service.usn for service in services}), 40)
 
         urls = ["http://10.0.0.1:49000/igd2desc.xml",
                 "http://10.0.0.1:49000/fboxdesc.xml",
@@ -60,10 +105,348 @@ class SSDPDiscoveryTest(unittest.TestCase):
                 "http://10.0.0.102:50201/dial.xml",
                 "http://10.0.0.151:8080/description.xml",
                 "http://10.0.0.144:80/description.xml"]
+        self.assertEqual({service.location for service in services}, set(urls))
         for service in services:
-            self.assertTrue(service.location in urls)
             self.assertTrue(service.location in str(service))
 
+    @mock.patch('socket.socket', side_effect=mock_socket)
+    def test_discover_deadline(self, mock_socket):
+        """Make sure discovery returns after the deadline and sends all rounds"""
+        start = time.monotonic()
+        services = SSDPDiscovery.discover(timeout=0.3, retries=3)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(len(services), 40)
+        self.assertEqual(mock_socket.call_count, 1)
+
+    @mock.patch('socket.socket', side_effect=mock_socket)
+    def test_discover_expected(self, mock_socket):
+        """Make sure discovery stops once enough services answered"""
+        start = time.monotonic()
+        services = SSDPDiscovery.discover(timeout=10, expected=3)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(len(services), 3)
+
+    @mock.patch('socket.socket', side_effect=mock_socket)
+    def test_discover_known_usns(self, mock_socket):
+        """Make sure discovery stops once all known services answered"""
+        usn = "uuid:00000004-0000-1010-8000-3052cbcc16ee::urn:dial-multiscreen-org:service:dial:1"
+        start = time.monotonic()
+        services = SSDPDiscovery.discover(timeout=10, usns=[usn])
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertIn(usn, [service.usn for service in services])
+
+    def test_parse_response(self):
+        """Test header names are matched independent of their case"""
+        response = _parse_response(
+            b"HTTP/1.1 200 OK\r\nLocation: http://10.0.0.102:52323/dmr.xml\r\n"
+            b"cache-control: no-cache, max-age = 60\r\nExt:\r\n"
+            b"Usn: uuid:test\r\nst:  upnp:rootdevice \r\n\r\nbody: ignored")
+        self.assertEqual(response.location, "http://10.0.0.102:52323/dmr.xml")
+        self.assertEqual(response.max_age, 60)
+        self.assertEqual(response.usn, "uuid:test")
+        self.assertEqual(response.st, "upnp:rootdevice")
+
+        for datagram in read_datagrams():
+            response = _parse_response(datagram.replace(b"\n", b"\r\n"))
+            self.assertIn(response.max_age, (1200, 1800))
+            self.assertTrue(response.location.startswith("http://10.0.0."))
+
+    def test_parse_response_invalid(self):
+        """Make sure invalid datagrams are ignored"""
+        self.assertIsNone(_parse_response(b""))
+        self.assertIsNone(_parse_response(b"garbage"))
+        self.assertIsNone(_parse_response(b"\xff\xfe\x00:\x81"))
+        self.assertIsNone(_parse_response(
+            b"HTTP/1.1 200 OK\r\nST: foo\r\n\r\n"))
+        self.assertIsNone(_parse_response(
+            b"HTTP/1.1 404 Not Found\r\nLOCATION: http://x\r\nUSN: uuid:x\r\n\r\n"))
+        self.assertIsNone(_parse_response(
+            b"M-SEARCH * HTTP/1.1\r\nLOCATION: http://x\r\nUSN: uuid:x\r\n\r\n"))
+
+    def test_response_from_text(self):
+        """Make sure responses can still be created from text"""
+        response = SSDPResponse("LOCATION: http://x\nCACHE-CONTROL: max-age\nUSN: uuid:x\n")
+        self.assertEqual(response.location, "http://x")
+        self.assertEqual(response.max_age, 1800)
+        self.assertIn("http://x", repr(response))
+
+
+class SSDPResponder(asyncio.DatagramProtocol):
+    """Local ssdp responder answering with the recorded traffic."""
+
+    def __init__(self):
+        self.transport = None
+        self.requests = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.requests.append(data)
+        service = re.search(rb"(?m)^ST: (.*)\r$", data).group(1).decode()
+        for datagram in read_datagrams():
+            if service == "ssdp:all" or re.search(
+                    rf"(?m)^ST: {re.escape(service)}\r?$", datagram.decode()):
+                self.transport.sendto(datagram, addr)
+
+
+class AsyncSSDPDiscoveryTest(unittest.IsolatedAsyncioTestCase):
+    """Asyncio SSDP discovery testing"""
+
+    async def asyncSetUp(self):
+        loop = asyncio.get_running_loop()
+        self.transport, self.responder = await loop.create_datagram_endpoint(
+            SSDPResponder, local_addr=("127.0.0.1", 0))
+        self.discovery = AsyncSSDPDiscovery(self.transport.get_extra_info("sockname"))
+
+    async def asyncTearDown(self):
+        self.transport.close()
+
+    async def test_discover(self):
+        """Test all services are yielded once"""
+        services = [service async for service in self.discovery.discover(timeout=0.3)]
+        self.assertEqual(len(services), 40)
+        self.assertEqual(len(self.responder.requests), 3)
+
+    async def test_discover_multiple_services(self):
+        """Test discovery of multiple service types in a single run"""
+        targets = ("urn:dial-multiscreen-org:service:dial:1", "upnp:rootdevice")
+        services = [service async for service in self.discovery.discover(
+            targets, timeout=0.3, retries=1)]
+        self.assertEqual(len(self.responder.requests), 2)
+        self.assertEqual({service.st for service in services}, set(targets))
+
+    async def test_discover_streaming(self):
+        """Test responses are yielded before the deadline is reached"""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        async for service in self.discovery.discover(timeout=10):
+            self.assertTrue(service.location)
+            break
+        self.assertLess(loop.time() - start, 1)
+
+
+class UnicastResponder(threading.Thread):
+    """Answer unicast search requests on the loopback interface"""
+
+    def __init__(self, answers=1):
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.answers = answers
+        self.requests = []
+
+    def run(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65507)
+            except OSError:
+                return
+            self.requests.append(data)
+            if len(self.requests) <= self.answers:
+                self.sock.sendto(read_datagrams()[0], addr)
+
+
+class SSDPUnicastTest(unittest.TestCase):
+    """Unicast search testing"""
+
+    def setUp(self):
+        self.responder = UnicastResponder()
+        self.responder.start()
+
+    def tearDown(self):
+        self.responder.sock.close()
+
+    def test_search_hosts(self):
+        start = time.monotonic()
+        responses = SSDPDiscovery.search_hosts(
+            ["127.0.0.1", "localhost"], "upnp:rootdevice", timeout=2,
+            port=self.responder.port)
+        # all hosts answered, no need to wait for the deadline
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(responses["127.0.0.1"].location, "http://10.0.0.1:49000/igd2desc.xml")
+        self.assertIn(b"HOST: 127.0.0.1:", self.responder.requests[0])
+        self.assertIn(b"ST: upnp:rootdevice", self.responder.requests[0])
+        self.assertNotIn(b"MX:", self.responder.requests[0])
+
+    def test_search_hosts_not_alive(self):
+        responses = SSDPDiscovery.search_hosts(
+            ["127.0.0.1", "127.0.0.2", "invalid.host.invalid"], timeout=0.2,
+            retries=2, port=self.responder.port)
+        self.assertTrue(responses["127.0.0.1"])
+        self.assertIsNone(responses["127.0.0.2"])
+        self.assertIsNone(responses["invalid.host.invalid"])
+        # hosts which answered are not searched again
+        self.assertEqual(len(self.responder.requests), 1)
+
+
+class MockDiscovery:
+    """Discovery answering with announcements of the given max-age"""
+
+    def __init__(self, services):
+        self.services = services
+        self.calls = []
+
+    def discover(self, service, **kwargs):
+        self.calls.append(kwargs)
+        return [_parse_notify(create_notify("ssdp:alive", usn=usn, max_age=max_age))[1]
+                for usn, max_age in self.services.items()]
+
+
+class SSDPDiscoveryCacheTest(unittest.TestCase):
+    """SSDP discovery cache testing"""
+
+    def setUp(self):
+        self.discovery = MockDiscovery({"uuid:a": 100, "uuid:b": 0})
+        self.cache = SSDPDiscoveryCache(self.discovery)
+
+    def test_cached(self):
+        self.discovery.services = {"uuid:a": 100}
+        self.assertEqual(len(self.cache.discover("ST", timeout=2)), 1)
+        self.assertEqual(len(self.cache.discover("ST")), 1)
+        self.assertEqual(self.discovery.calls, [{"timeout": 2}])
+
+        self.cache.discover("other")
+        self.assertEqual(len(self.discovery.calls), 2)
+
+    def test_refresh_expired(self):
+        self.cache.discover("ST")
+        # only the expired service is searched, it does not answer anymore
+        self.discovery.services = {"uuid:a": 100}
+        services = self.cache.discover("ST")
+        self.assertEqual(self.discovery.calls[-1], {"usns": {"uuid:b"}})
+        self.assertEqual([service.usn for service in services], ["uuid:a"])
+
+    def test_force(self):
+        self.discovery.services = {"uuid:a": 100}
+        self.cache.discover("ST")
+        self.discovery.services = {"uuid:c": 100}
+        services = self.cache.discover("ST", force=True)
+        self.assertEqual([service.usn for service in services], ["uuid:c"])
+        self.assertEqual(self.discovery.calls, [{}, {}])
+
+        self.cache.clear()
+        self.cache.discover("ST")
+        self.assertEqual(len(self.discovery.calls), 3)
+
+    def test_background(self):
+        self.cache.background = True
+        self.cache.discover("ST")
+        self.discovery.services = {"uuid:a": 100, "uuid:b": 100}
+        # expired responses are returned while they are revalidated
+        services = self.cache.discover("ST")
+        self.assertEqual(len(services), 2)
+        for _ in range(100):
+            if len(self.discovery.calls) == 2 and not self.cache._refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.discovery.calls[-1], {"usns": {"uuid:b"}})
+        self.cache.discover("ST")
+        self.assertEqual(len(self.discovery.calls), 2)
+
+
+class SSDPRegistryTest(unittest.TestCase):
+    """SSDP registry testing"""
+
+    def setUp(self):
+        self.registry = SSDPRegistry()
+        self.events = []
+        self.unsubscribe = self.registry.subscribe(
+            lambda event, response: self.events.append((event, response.usn)))
+
+    def test_parse_notify(self):
+        nts, response = _parse_notify(create_notify("ssdp:alive", max_age=60))
+        self.assertEqual(nts, "ssdp:alive")
+        self.assertEqual(response.max_age, 60)
+        self.assertEqual(response.st, "urn:schemas-sony-com:service:IRCC:1")
+        self.assertEqual(response.location, "http://10.0.0.102:52323/dmr.xml")
+
+        nts, response = _parse_notify(create_notify("ssdp:byebye"))
+        self.assertEqual(nts, "ssdp:byebye")
+        self.assertEqual(response.usn, "uuid:test::urn:schemas-sony-com:service:IRCC:1")
+
+        self.assertEqual(_parse_notify(read_datagrams()[0]), (None, None))
+        self.assertEqual(_parse_notify(b"NOTIFY * HTTP/1.1\r\nNTS: ssdp:alive\r\n\r\n"),
+                         (None, None))
+
+    def test_update(self):
+        _, response = _parse_notify(create_notify("ssdp:alive"))
+        self.registry.update(response)
+        self.registry.update(response)
+        self.assertEqual(self.events, [(SSDPEvent.ADDED, response.usn)])
+
+        _, moved = _parse_notify(create_notify("ssdp:alive", location="http://10.0.0.103/dmr.xml"))
+        self.registry.update(moved)
+        self.assertEqual(self.events[-1], (SSDPEvent.UPDATED, response.usn))
+        self.assertEqual(self.registry.services[response.usn], moved)
+
+    def test_remove(self):
+        _, response = _parse_notify(create_notify("ssdp:alive"))
+        self.registry.update(response)
+        self.registry.remove(response.usn)
+        self.registry.remove(response.usn)
+        self.assertEqual(self.events, [(SSDPEvent.ADDED, response.usn),
+                                       (SSDPEvent.REMOVED, response.usn)])
+        self.assertFalse(self.registry.services)
+
+    def test_expire(self):
+        _, short = _parse_notify(create_notify("ssdp:alive", usn="uuid:short", max_age=10))
+        _, long = _parse_notify(create_notify("ssdp:alive", usn="uuid:long", max_age=100))
+        self.registry.update(short, now=0)
+        self.registry.update(long, now=0)
+
+        self.registry.expire(now=50)
+        self.assertEqual(list(self.registry.services), ["uuid:long"])
+        self.assertEqual(self.events[-1], (SSDPEvent.REMOVED, "uuid:short"))
+
+        # a renewed announcement extends the lifetime
+        self.registry.update(long, now=90)
+        self.registry.expire(now=150)
+        self.assertEqual(list(self.registry.services), ["uuid:long"])
+
+    def test_subscriber_error(self):
+        self.registry.subscribe(mock.Mock(side_effect=ValueError))
+        _, response = _parse_notify(create_notify("ssdp:alive"))
+        self.registry.update(response)
+        self.assertEqual(len(self.events), 1)
+
+        self.unsubscribe()
+        self.registry.remove(response.usn)
+        self.assertEqual(len(self.events), 1)
+
+
+class SSDPListenerTest(unittest.IsolatedAsyncioTestCase):
+    """SSDP announcement listener testing"""
+
+    async def test_listen(self):
+        events = asyncio.Queue()
+        listener = SSDPListener(address=("127.0.0.1", 0))
+        listener.registry.subscribe(lambda event, response: events.put_nowait(event))
+        await listener.start()
+
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, remote_addr=listener.sockname)
+        try:
+            transport.sendto(create_notify("ssdp:alive"))
+            self.assertEqual(await asyncio.wait_for(events.get(), 1), SSDPEvent.ADDED)
+            transport.sendto(read_datagrams()[0])
+            transport.sendto(create_notify("ssdp:byebye"))
+            self.assertEqual(await asyncio.wait_for(events.get(), 1), SSDPEvent.REMOVED)
+        finally:
+            transport.close()
+            listener.stop()
+
+    async def test_expire(self):
+        listener = SSDPListener(address=("127.0.0.1", 0), expiry_interval=0.01)
+        _, response = _parse_notify(create_notify("ssdp:alive", max_age=0))
+        listener.registry.update(response)
+        await listener.start()
+        await asyncio.sleep(0.05)
+        listener.stop()
+        self.assertFalse(listener.registry.services)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,104 @@
+"""Test storing many devices"""
+import os.path
+import sys
+import unittest
+from inspect import getsourcefile
+
+from requests.cookies import RequestsCookieJar
+
+current_dir = os.path.dirname(os.path.abspath(getsourcefile(lambda: 0)))
+sys.path.insert(0, current_dir[:current_dir.rfind(os.path.sep)])
+# cannot be imported at a different position because path modification
+# is necessary to load the local library.
+# otherwise it must be installed after every change
+from sonyapilib.device import SonyDevice, XmlApiObject
+from sonyapilib.fleet import load_devices
+from sonyapilib.store import DeviceStore
+sys.path.pop(0)
+
+
+def create_device(host, nickname="test", mac=None):
+    """Create a device with some data"""
+    device = SonyDevice(host, nickname)
+    device.mac = mac
+    device.apps["YouTube"] = XmlApiObject({"name": "YouTube", "id": "com.sony.iptv.type.ytleanback"})
+    return device
+
+
+class DeviceStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = DeviceStore(":memory:")
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_save_load(self):
+        device = create_device("a", mac="10:08:B1:31:81:B5")
+        self.assertIn("apps", self.store.save(device))
+
+        restored = self.store.load("a")
+        self.assertEqual(restored.__getstate__().keys(), device.__getstate__().keys())
+        self.assertEqual(restored.apps["YouTube"].id, "com.sony.iptv.type.ytleanback")
+        self.assertEqual(restored.mac, device.mac)
+        self.assertIsNone(restored.session)
+        self.assertEqual(restored.save_to_json.__self__, restored)
+        self.assertIsNone(self.store.load("unknown"))
+
+    def test_incremental_save(self):
+        device = create_device("a")
+        self.store.save(device)
+        self.assertEqual(self.store.save(device), [])
+
+        device.mac = "10:08:B1:31:81:B5"
+        device.cookies = RequestsCookieJar()
+        device.cookies.set("auth", "foo")
+        self.assertEqual(sorted(self.store.save(device)), ["cookies", "mac"])
+
+        restored = self.store.load("a")
+        self.assertEqual(restored.cookies.get("auth"), "foo")
+        restored.apps.clear()
+        self.assertEqual(self.store.save(restored), ["apps"])
+        self.assertEqual(self.store.load("a").apps, {})
+
+        del restored.icons
+        self.assertEqual(self.store.save(restored), ["icons"])
+        self.assertFalse(hasattr(self.store.load("a"), "icons"))
+
+    def test_find(self):
+        self.store.save(create_device("a", "living room", "10:08:B1:31:81:B5"))
+        self.store.save(create_device("b", "office", "30-52-cb-cc-16-ee"))
+        self.store.save(create_device("c", "office"))
+
+        self.assertEqual(self.store.find(host="a"), ["a"])
+        self.assertEqual(self.store.find(mac="30-52-cb-cc-16-ee"), ["b"])
+        self.assertEqual(self.store.find(nickname="office"), ["b", "c"])
+        self.assertEqual(self.store.find(nickname="office", mac="30-52-cb-cc-16-ee"), ["b"])
+        self.assertEqual(self.store.find(), ["a", "b", "c"])
+
+        device = self.store.load("c")
+        device.nickname = "kitchen"
+        self.store.save(device)
+        self.assertEqual(self.store.find(nickname="office"), ["b"])
+
+    def test_load_all_delete(self):
+        for host in ["a", "b", "c"]:
+            self.store.save(create_device(host))
+        self.store.delete("b")
+        self.assertEqual([device.host for device in self.store.load_all()], ["a", "c"])
+        self.assertEqual(self.store.find(), ["a", "c"])
+
+        devices, failures = load_devices(self.store)
+        self.assertEqual(len(devices), 2)
+        self.assertFalse(failures)
+
+    def test_reopen(self):
+        with DeviceStore("file:memdb?mode=memory&cache=shared") as store:
+            store.save(create_device("a"))
+            with DeviceStore("file:memdb?mode=memory&cache=shared") as reopened:
+                device = reopened.load("a")
+                self.assertEqual(reopened.save(device), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+"""Test the ScalarWebAPI client"""
+import os.path
+import sys
+import threading
+import time
+import unittest
+from inspect import getsourcefile
+from unittest import mock
+
+from requests import ConnectionError as RequestsConnectionError
+
+current_dir = os.path.dirname(os.path.abspath(getsourcefile(lambda: 0)))
+sys.path.insert(0, current_dir[:current_dir.rfind(os.path.sep)])
+# cannot be imported at a different position because path modification
+# is necessary to load the local library.
+# otherwise it must be installed after every change
+from sonyapilib import webapi
+from sonyapilib.device import SonyDevice
+from sonyapilib.webapi import LATEST_VERSION, WebApiError
+sys.path.pop(0)
+
+BASE_URL = "http://test/sony/"
+CHANNELS = [{"uri": f"tv:dvbt?trip=1.1.{index}", "title": f"Channel {index}"}
+            for index in range(120)]
+
+
+class MockResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+
+def mocked_requests_post(url, json=None, **kwargs):
+    method = json["method"]
+    if method == "getInterfaceInformation":
+        return MockResponse({"result": [{"modelName": "KD-55XF9005",
+                                         "interfaceVersion": "5.0.1"}], "id": json["id"]})
+    if method == "getSystemInformation":
+        return MockResponse({"result": [{"fwVersion": "PKG6.5618"}], "id": json["id"]})
+    if method == "getVersions":
+        return MockResponse({"result": [["1.0", "1.1"]], "id": json["id"]})
+    if method == "getMethodTypes":
+        version = json["params"][0]
+        results = [["getPowerStatus", [], ['{"status":"string"}'], version]]
+        if version == "1.0":
+            results.append(["getPlayingContentInfo", [], ['{"uri":"string"}'], "1.0"])
+        return MockResponse({"results": results, "id": json["id"]})
+    if method == "getPowerStatus":
+        return MockResponse({"result": [{"status": "active"}], "id": json["id"]})
+    if method == "slow":
+        time.sleep(0.1)
+        return MockResponse({"result": [json["params"]], "id": json["id"]})
+    if method == "getContentList":
+        query = json["params"][0]
+        start = query["stIdx"]
+        return MockResponse({"result": [CHANNELS[start:start + query["cnt"]]], "id": json["id"]})
+    if method == "getSourceList":
+        return MockResponse({"result": [[{"source": "tv:dvbt"}, {"source": "tv:dvbc"}]],
+                             "id": json["id"]})
+    if method == "offline":
+        raise RequestsConnectionError()
+    return MockResponse({"error": [12, "No Such Method"], "id": json["id"]})
+
+
+def create_device(host="test"):
+    device = SonyDevice(host, "test")
+    device.api_version = 4
+    device.base_url = BASE_URL.replace("test", host)
+    return device
+
+
+class WebApiClientTest(unittest.TestCase):
+
+    def setUp(self):
+        webapi._SIGNATURES.clear()
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    def test_call(self, mock_post):
+        client = create_device().webapi
+        self.assertEqual(client.call("system", "getPowerStatus"), [{"status": "active"}])
+        self.assertEqual(mock_post.call_args[0][0], BASE_URL + "system")
+        self.assertEqual(mock_post.call_args[1]["json"],
+                         {"method": "getPowerStatus", "params": [], "id": 1, "version": "1.0"})
+        client.call("system", "getPowerStatus")
+        self.assertEqual(mock_post.call_args[1]["json"]["id"], 2)
+
+        with self.assertRaises(WebApiError) as context:
+            client.call("system", "unknown")
+        self.assertEqual(context.exception.code, 12)
+        self.assertEqual(context.exception.message, "No Such Method")
+
+        # methods might change the state of the device, only reads are retried
+        mock_post.reset_mock()
+        with self.assertRaises(RequestsConnectionError):
+            client.call("system", "offline", log_errors=False)
+        self.assertEqual(mock_post.call_count, 1)
+        with mock.patch('time.sleep'), self.assertRaises(RequestsConnectionError):
+            client.call("system", "offline", log_errors=False, operation="status")
+        self.assertEqual(mock_post.call_count, 3)
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    def test_signatures(self, mock_post):
+        client = create_device().webapi
+        signatures = client.signatures("system")
+        self.assertEqual(set(signatures["getPowerStatus"]), {"1.0", "1.1"})
+        self.assertEqual(signatures["getPlayingContentInfo"]["1.0"].results, ['{"uri":"string"}'])
+        self.assertTrue(client.supports("system", "getPowerStatus", "1.1"))
+        self.assertFalse(client.supports("system", "getPlayingContentInfo", "1.1"))
+        self.assertFalse(client.supports("system", "setPowerStatus"))
+        # getInterfaceInformation, getSystemInformation, getVersions and
+        # getMethodTypes for both versions
+        self.assertEqual(mock_post.call_count, 5)
+
+        # the latest version is only used if requested
+        client.call("system", "getPowerStatus")
+        self.assertEqual(mock_post.call_args[1]["json"]["version"], "1.0")
+        client.call("system", "getPowerStatus", version=LATEST_VERSION)
+        self.assertEqual(mock_post.call_args[1]["json"]["version"], "1.1")
+        self.assertEqual(mock_post.call_count, 7)
+
+        # devices of the same model and firmware share the signatures
+        other = create_device("other").webapi
+        self.assertIs(other.signatures("system"), signatures)
+        self.assertEqual(mock_post.call_count, 9)
+
+        updated = create_device("updated").webapi
+        updated._firmware = "PKG6.6000"
+        self.assertIsNot(updated.signatures("system"), signatures)
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    def test_discovery_once(self, mock_post):
+        devices = [create_device(f"host{index}") for index in range(4)]
+        for device in devices:
+            device.model_name = "KD-55XF9005"
+            device.webapi._interface = {"interfaceVersion": "5.0.1"}
+            device.webapi._firmware = "PKG6.5618"
+        threads = [threading.Thread(target=device.webapi.signatures, args=("system",))
+                   for device in devices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(mock_post.call_count, 3)
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    def test_call_many(self, mock_post):
+        client = create_device().webapi
+        start = time.monotonic()
+        calls = [("system", "slow", [index]) for index in range(4)]
+        calls.append(("system", "unknown", None))
+        results = client.call_many(calls)
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertEqual(results[:4], [[[index]] for index in range(4)])
+        self.assertIsInstance(results[4], WebApiError)
+        ids = {call[1]["json"]["id"] for call in mock_post.call_args_list}
+        self.assertEqual(len(ids), 5)
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    def test_iter_content(self, mock_post):
+        device = create_device()
+        self.assertEqual(device.get_sources("tv"), [{"source": "tv:dvbt"}, {"source": "tv:dvbc"}])
+        self.assertEqual(mock_post.call_args[1]["json"]["params"], [{"scheme": "tv"}])
+
+        self.assertEqual(list(device.iter_content("tv:dvbt")), CHANNELS)
+        requests = [call[1]["json"] for call in mock_post.call_args_list[1:]]
+        self.assertEqual([request["params"][0]["stIdx"] for request in requests], [0, 50, 100])
+        self.assertEqual(requests[0]["params"][0]["uri"], "tv:dvbt")
+        self.assertEqual(requests[0]["version"], "1.5")
+
+        # pages which are completely used end with an empty one
+        mock_post.reset_mock()
+        self.assertEqual(len(list(device.iter_content("tv:dvbt", page_size=60))), 120)
+        self.assertEqual(mock_post.call_count, 3)
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    def test_prefetch(self, mock_post):
+        def requested():
+            return [call[1]["json"]["params"][0]["stIdx"] for call in mock_post.call_args_list]
+
+        content = create_device().iter_content("tv:dvbt", page_size=10)
+        self.assertEqual(next(content), CHANNELS[0])
+        # the next page is requested while the first one is used
+        time.sleep(0.05)
+        self.assertEqual(requested(), [0, 10])
+
+        # no more pages are requested once the caller stops
+        for _ in range(9):
+            next(content)
+        content.close()
+        time.sleep(0.05)
+        self.assertEqual(requested(), [0, 10])
+
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    def test_iter_pages_error(self, mock_post):
+        pages = create_device().webapi.iter_pages("avContent", "unknown")
+        with self.assertRaises(WebApiError):
+            next(pages)
+
+
+if __name__ == '__main__':
+    unittest.main()